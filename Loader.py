@@ -1,14 +1,23 @@
-import hashlib
-import io
 import os
-import re
 import shutil
-import zipfile
-
-from cli_parser import get_parser
-from get_request import get_request
-from LoaderDB import LoaderDB
-from url_config import get_urls_and_query
+import socket
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date, timedelta
+
+from concurrency import Heartbeat, HostLimiter, map_ordered, MAX_PER_HOST
+from disk import DiskBudgetError
+from filters import default_filters
+from get_request import get_request, make_session, CHUNK_SIZE, LoadedFile
+from metrics import RunMetrics
+from opensearch import parse_page
+from pipeline import BoundedStage, extract_zip, PART_SUFFIX
+from presence import PresenceIndex
+from remote_zip import open_remote, RangeNotSupportedError
+from retry import UnauthorizedError, DEFAULT_POLICY
+from scheduler import DownloadScheduler
+from store import materialize, members_key
+from url_config import get_urls_and_query, member_filters, urls
 
 # from logger_pkg import configure_logger
 # logger = configure_logger(__name__,  # is duplicated by snappy but can't do anything
@@ -18,40 +27,27 @@ from url_config import get_urls_and_query
 # if you don't have logger_pkg - use standard logging
 import logging
 # # if you want to control logs uncomment all lines
-import sys
-logging.basicConfig(stream=sys.stdout, level=logging.INFO)  # default logging.WARNING
+# import sys
+# logging.basicConfig(stream=sys.stdout, level=logging.INFO)  # default logging.WARNING
 logger = logging.getLogger()
 
-RUN_FROM_CLI = True
-
-# if RUN_FROM_CLI:
-
-parser = get_parser()
-args = parser.parse_args()
-# args = parser.parse_args(['--help'])  # ['--query']
-if args.s[0] in ('Sentinel-1', 'Sentinel-2', 'Sentinel-3') and args.a == ('s3guest', 's3guest'):
-    parser.error("Sentinel-1,2,3 requires -a [credentials for sci.hub]")
-print(args)
-
-
-REGEX = r"(?<=<str name=\"{}\">).*(?=</str>)"
-RE_DATE = r"(?<=<date name=\"beginposition\">).*(?=</date>)"
-RE_NO_RESULTS = r"(?<=<subtitle>)(Displaying 0 results\.)"
-RE_N_IMAGES = r'(?<=<opensearch:totalResults>)\d+'
-RE_S2_CLOUDS = r'(?<=\"cloudcoverpercentage\">)\d+\.\d+'
 
 MAX_REQUEST_N_IMAGES = 100
-MAX_CLOUD_COVER = 90
+SEARCH_WORKERS = 4  # pages of one query loaded in parallel
+PAGE_RETRIES = 2
+QUERY_CACHE_TTL = 30 * 24 * 3600  # s, searched periods are taken from the database during this time
+QUERY_CACHE_SETTLE_DAYS = 3  # the most recent days are always searched again
+MAX_DOWNLOAD_ATTEMPTS = 5  # failed products are taken from the downloads queue again in the next runs
+LEASE_SECONDS = 300  # claimed product is given to another worker if its owner didn't renew the lease
+SHARED_POLL = 5  # s between checks of the products which other workers of a shared queue are loading
 
 # RE_OLCI_DATE = r"S3A_OL_1_EFR____\d{8}T\d{6}"
 # RE_SLSTR_DATE = r"S3A_SL_1_RBT____\d{8}T\d{6}"
-TYPICAL_CROPPED_LENGTH = 31
-SLSTR_PATTERN = '_SL_'
 
 
 B2MB = 1e-6
 
-TMP_BYTES_PATH = './loaded'
+TMP_BYTES_PREFIX = 'loaded_'
 
 
 class Loader:
@@ -61,129 +57,467 @@ class Loader:
                  cropped_path='./cropped',
                  auth=('username', 'password'),
                  product_type_or_level=None,    # or 'productlevel:L1'
-                 loader_db=LoaderDB(':memory:')):    # or 'productlevel:L1'
-        self.url_dict, self.query_template = get_urls_and_query(platform_name)
+                 loader_db=':memory:',  # LoaderDB, path to open it (when it is needed) or None
+                 tmp_path='./',
+                 workers=1,
+                 max_per_host=MAX_PER_HOST,
+                 chunk_size=CHUNK_SIZE,
+                 cache_ttl=QUERY_CACHE_TTL,  # None or 0 => always search the hub
+                 shared_queue=False,  # other processes / hosts load from the same loader_db
+                 worker_id=None,
+                 scheduler=None,  # scheduler.DownloadScheduler, can be shared by several Loaders
+                 retry_policy=None,  # retry.RetryPolicy
+                 metrics=None,  # metrics.RunMetrics, exported at the end of download()
+                 extract_workers=0,  # processes extracting while the next products are downloaded, 0 => in turn
+                 max_pending_extracts=None,  # downloaded but not extracted products, default 2 per extract worker
+                 members=None,  # globs of zip members to extract, default from url_config.member_filters
+                 remote_members=False,  # fetch only `members` with Range requests instead of the whole zip
+                 filters=None,  # filters.FilterSpec, default: filters.default_filters
+                 session=None,  # the rest is shared by the Loaders of a campaign, see campaign.Campaign
+                 host_limiter=None,
+                 presence=None,
+                 dedup=None,  # concurrency.OncePerKey, every uuid is loaded once
+                 store=None,  # store.ProductStore, products are loaded once for all the load paths
+                 disk_budget=None):  # disk.DiskBudget, downloads start only if their space is reserved
+        self.filters = filters or default_filters(urls[platform_name]['platformname'])
+        self.url_dict, self.query_template = get_urls_and_query(platform_name, self.filters)
         self.load_path = load_path
         self.cropped_path = cropped_path  # to check if already loaded
-        self.db = loader_db
+        self.tmp_path = tmp_path  # every product gets its own tmp file here, so they can be loaded in parallel
+        self.presence = presence or PresenceIndex(load_path, cropped_path)
+        self._db = loader_db
+        self.cache_ttl = cache_ttl
+        self.shared_queue = shared_queue
+        self.scheduler = scheduler or DownloadScheduler()
+        self.retry_policy = retry_policy or DEFAULT_POLICY
+        self.metrics = metrics or RunMetrics()
+        self.worker_id = worker_id or '{}:{}:{}'.format(socket.gethostname(), os.getpid(), id(self))
+        self.workers = workers
+        self.host_limiter = host_limiter or HostLimiter(max_per_host)
+        self.chunk_size = chunk_size
+        self.hash_names = ('md5', )  # hashed while streaming, the hub publishes only md5 sums
+        self.extract_workers = extract_workers
+        self.max_pending_extracts = max_pending_extracts
+        self.extractor = None  # pipeline.BoundedStage during download()
+        self.dedup = dedup
+        self.store = store
+        self._reextract = set()  # uuids on disk but extracted with other members
+        self.disk_budget = disk_budget
+        if disk_budget is not None:
+            disk_budget.watch(load_path, self.presence, tmp_path, TMP_BYTES_PREFIX)
+        self.checksum_pool = ThreadPoolExecutor(max_workers=workers)  # check sums are loaded along with the bodies
 
         if platform_name in ('Sentinel-1', 'Sentinel-2', 'Sentinel-3'):
             self.url_dict['auth'] = auth
+        # a download and its check sum per worker, +1 connection for queries
+        self.session = session or make_session(pool_size=max(2 * workers, SEARCH_WORKERS) + 1,
+                                               auth=self.url_dict['auth'])
         if product_type_or_level is None:
             product_type_or_level = self.url_dict['producttype']
             logger.warning('\n`product_type_or_level` was not specified. '
                            'Default type will be used for your platform: \n{}\n'.format(product_type_or_level))
         self.producttype = 'producttype:{}'.format(product_type_or_level)
+        # searched periods are remembered per query: the same type with other filters is searched again
+        clause = self.filters.query_clause(self.url_dict['platformname'])
+        self.query_key = self.producttype + (' AND ({})'.format(clause) if clause else '')
+        if members is None:
+            members = member_filters.get((self.url_dict['platformname'], product_type_or_level))
+        self.members = members
+        self.remote_members = remote_members and members is not None
+
+    @property
+    def db(self):
+        """ LoaderDB given as a path is opened on the first use, not when Loader is created """
+        if isinstance(self._db, str):
+            from LoaderDB import LoaderDB
+            self._db = LoaderDB(self._db)
+        return self._db
+
+    @db.setter
+    def db(self, loader_db):
+        self._db = loader_db
 
     def download(self,
                  polygon='Nederland 2deg',  # or wkt
                  period=("2018-04-01", "2018-04-01")):
-        results = self.query_copernicus(polygon, period)
-        names = results['names']
-        uuids = results['uuids']
-        n_images = results['n_images']
-        logger.info('Found {} images'.format(n_images))
-        for i in range(n_images):  # for i, j in [(x, x + 1) for x in range(0, n_images, 2)]  # last one is step
-            if i in results['i_clouded']:
-                logger.warning('Too clouded - {}. Skipping'.format(names[i]))
-                continue
-            if '_T29TQE_' in names[i]:  # temporal measure for S2 as I don't know TQE TTK difference
-                logger.info(f'SKIPPED TQE: {names[i]}')
+        products = self.query_copernicus(polygon, period)
+        logger.info('Found {} images'.format(len(products)))
+        if self.disk_budget is not None:
+            self.disk_budget.clean_orphans()
+        to_load = self.filters.apply(products)
+        if not self.extract_workers:
+            return self._download(to_load)
+        with BoundedStage(self.extract_workers, self.max_pending_extracts) as self.extractor:
+            try:
+                return self._download(to_load)
+            finally:
+                self.extractor = None
+
+    def _download(self, to_load):
+        if not self.db:
+            to_load = self.scheduler.order(to_load)
+            for product in to_load:
+                self.scheduler.progress.expect(product.size)
+            jobs = map_ordered(lambda p: self._load_job(p.uuid, p.name, p.size), to_load, self.workers)
+            # list of True (product is on disk) / False (failed), in the order of `to_load`
+            loaded = [self._wait_job(p.uuid, job) for p, job in zip(to_load, jobs)]
+            logger.info('{} of {} products are on disk. {}'.format(sum(loaded), len(loaded),
+                                                                  self.scheduler.progress.report()))
+            self.metrics.export()
+            return [((p.uuid, p.name), is_loaded) for p, is_loaded in zip(to_load, loaded)]
+
+        # the queue survives crashes: what was not finished last time is loaded first
+        platform = self.url_dict['platformname']
+        members = members_key(self.members)
+        self.db.enqueue_downloads(to_load, platform, self.load_path, members)
+        missing, present = [], []
+        for p in to_load:
+            if self.presence.has_cropped(p.name):
                 continue
-            self.load_if_not_yet(uuids[i], names[i])
+            (present if self.presence.has_loaded(p.name) else missing).append(p.uuid)
+        # products removed from disk or extracted with other members are loaded again
+        self._reextract.update(self.db.requeue_extracted(platform, self.load_path, missing, present, members))
+        if not self.shared_queue:  # nobody else works on this queue => unfinished products are left by a crash
+            self.db.reset_in_progress(platform, self.load_path)
+        run_started = time.time()
+        n_waiting, bytes_waiting = self.db.get_queue_bytes(platform, self.load_path, members)
+        self.scheduler.progress.expect(bytes_waiting)
+        logger.info('{} products ({:.1f} MB) are waiting in the queue'.format(n_waiting, bytes_waiting * B2MB))
+        with Heartbeat(lambda: self.db.renew_leases(self.worker_id, LEASE_SECONDS), LEASE_SECONDS / 3):
+            results = self._drain_all(run_started)
+            while True:
+                self.db.flush_download_states()
+                drained = {uuid_name[0]: loaded for _, uuid_name, loaded in results}
+                states = self.db.get_download_states(self.load_path,
+                                                     [p.uuid for p in to_load if p.uuid not in drained])
+                now = time.time()
+                if not self.shared_queue or not any(state in ('in_progress', 'verified') and lease_expires > now
+                                                    for state, lease_expires in states.values()):
+                    break
+                # other workers are loading requested products: wait for them, or take over if their leases expire
+                time.sleep(SHARED_POLL)
+                results = sorted(results + self._drain_all(run_started))
+        # every requested product (loaded in this run or before), then the ones left in the queue by earlier runs,
+        # the presence index may not have seen the products loaded by other workers yet
+        requested = {p.uuid for p in to_load}
+        results = [((p.uuid, p.name), drained[p.uuid] if p.uuid in drained else
+                    states.get(p.uuid, (None, ))[0] == 'extracted' or
+                    self.presence.has_cropped(p.name) or self.presence.has_loaded(p.name)) for p in to_load] + \
+                  [(uuid_name, loaded) for _, uuid_name, loaded in results if uuid_name[0] not in requested]
+        logger.info('{} of {} products are on disk. {}'.format(sum(loaded for _, loaded in results), len(results),
+                                                              self.scheduler.progress.report()))
+        self.metrics.export()
+        return results
+
+    def _drain_all(self, run_started):
+        """ `workers` drain the queue, returns [(id, (uuid, name), loaded)] sorted by id """
+        drained = map_ordered(lambda _: self._drain_queue(run_started), range(self.workers), self.workers)
+        return sorted((job_id, (uuid, name), self._wait_job(uuid, job))
+                      for worker_results in drained for job_id, (uuid, name), job in worker_results)
+
+    def _drain_queue(self, run_started):
+        """
+        one worker: claims products one by one until the queue is empty, returns [(id, (uuid, name), job)],
+        see _load_job
+        """
+        results = []
+        members = members_key(self.members)
+        while True:
+            claimed = self.db.claim_downloads(self.url_dict['platformname'], self.load_path, self.worker_id, 1,
+                                              LEASE_SECONDS, MAX_DOWNLOAD_ATTEMPTS, run_started,
+                                              order=self.scheduler.policy, members=members)
+            if not claimed:
+                return results
+            job_id, uuid, name, size = claimed[0]
+            results.append((job_id, (uuid, name), self._load_job(uuid, name, size)))
+            logger.info(self.scheduler.progress.report())
+
+    def _load_job(self, uuid, name, size=None):
+        """
+        load_if_not_yet which never raises, so one broken product doesn't stop the others.
+        Returns loaded (bool) or Future of it if the product is being extracted (see _wait_job)
+        """
+        try:
+            if self.dedup is None:
+                return self.load_if_not_yet(uuid, name, size=size)
+            (job, load_path, members), first = self.dedup.run(
+                uuid, lambda: (self.load_if_not_yet(uuid, name, size=size), self.load_path, self.members))
+            if first:
+                return job
+            loaded = self._wait_job(uuid, job)  # was loaded by another Loader, maybe to another load_path
+            if loaded and self.store is not None:
+                return self.load_if_not_yet(uuid, name, size=size)  # linked from the store
+            if loaded and os.path.abspath(load_path) != os.path.abspath(self.load_path):
+                return self._link_from(uuid, name, load_path, members)
+            self._set_state(uuid, 'extracted' if loaded else 'failed',
+                            error=None if loaded else 'failed in another job',
+                            members=members_key(members) if loaded else None)
+            return loaded
+        except UnauthorizedError:
+            raise  # the same for all the products
+        except DiskBudgetError as e:
+            logger.error('{} is not loaded: {}'.format(name, e))
+            self._set_state(uuid, 'failed', error=repr(e))
+            return False
+        except Exception as e:
+            logger.exception('Failed to load {}'.format(name))
+            self._set_state(uuid, 'failed', error=repr(e))
+            return False
+
+    def _link_from(self, uuid, name, load_path, members):
+        """ the product loaded by another job (with its `members`) into `load_path` is linked into this load_path """
+        entries = [entry for entry in os.listdir(load_path) if entry.split('.', 1)[0] == name] \
+            if os.path.isdir(load_path) else []
+        if not entries:  # f.e. only cropped there, this job loads it in the next run
+            logger.warning('{} is not in {}, it stays in the queue'.format(name, load_path))
+            self._set_state(uuid, 'pending')
+            return False
+        if not os.path.exists(os.path.join(self.load_path, entries[0])):
+            os.makedirs(self.load_path, exist_ok=True)
+            materialize(os.path.join(load_path, entries[0]), os.path.join(self.load_path, entries[0]))
+            logger.info('{} is linked from {} to {}'.format(entries[0], load_path, self.load_path))
+        self.presence.add_loaded(entries[0])
+        self._set_state(uuid, 'extracted', members=members_key(members))
+        return True
+
+    def _wait_job(self, uuid, job):
+        if not isinstance(job, Future):
+            return job
+        try:
+            return job.result()
+        except Exception as e:
+            logger.exception('Failed to extract {}'.format(uuid))
+            self._set_state(uuid, 'failed', error=repr(e))
+            return False
+
+    def _set_state(self, uuid, state, n_bytes=None, error=None, members=None):
+        if self.db:
+            self.db.set_download_state(uuid, self.load_path, state, n_bytes, error, owner=self.worker_id,
+                                       members=members)
 
     def load_if_not_yet(self,
                         uuid,
                         name,
-                        tmp_bytes_path=TMP_BYTES_PATH):
-        file_in_cropped = self.is_file_in(self.cropped_path, name, cropped=True)
-        file_in_loaded = self.is_file_in(self.load_path, name)
-        if file_in_cropped or file_in_loaded:
-            return
-        loaded = self.download_timeout(uuid, tmp_bytes_path)
+                        tmp_bytes_path=None,
+                        size=None):  # as reported by the hub, for the scheduler
+        """
+        Returns True if the product is on disk. During download() with `extract_workers` the zip is extracted
+        by the extract stage while this worker goes on with the next product, then Future of True is returned
+        """
+        if self.presence.is_cropped(name) or (uuid not in self._reextract and self.presence.is_loaded(name)):
+            self._set_state(uuid, 'extracted')
+            self.scheduler.progress.expect(-(size or 0))  # nothing to load
+            return True
+        if self.store is not None:
+            entry = self.store.materialize(uuid, self.members, self.load_path)
+            if entry is not None:
+                self.metrics.count('store_hits', 1, uuid)
+                self.scheduler.progress.expect(-(size or 0))
+                return self._extracted(uuid, entry)
+        self._reextract.discard(uuid)
+        self._set_state(uuid, 'in_progress')
+        if self.remote_members and self.url_dict['platformname'] != 'Sentinel-5':
+            extracted = self.load_members(uuid)
+            if extracted is not None:
+                return extracted
+        if tmp_bytes_path is None:
+            tmp_bytes_path = self._tmp_bytes_path(uuid)
+        if self.disk_budget is None:
+            return self._download_and_extract(uuid, name, tmp_bytes_path, size)
+        # the store folder isn't known before the check sum, it's on the volume of the store root
+        unzip_path = self.store.root if self.store is not None else self.load_path
+        self.disk_budget.reserve(uuid, self.disk_budget.needs(size, tmp_bytes_path, unzip_path))
+        try:
+            job = self._download_and_extract(uuid, name, tmp_bytes_path, size)
+        except BaseException:
+            self.disk_budget.release(uuid)
+            raise
+        return self.disk_budget.release_when_done(uuid, job)
+
+    def _download_and_extract(self, uuid, name, tmp_bytes_path, size=None):
+        loaded = self.download_timeout(uuid, tmp_bytes_path, size)
         if loaded is None:
             logger.critical('Was not able to download or check sums for image {} uuid {}'.format(name, uuid))
-            return
+            self._set_state(uuid, 'failed', error='download or check sums failed')
+            return False
+        self._set_state(uuid, 'verified', n_bytes=loaded.size)
+        unzip_path = self._unzip_path(uuid, loaded.digests['md5'])
         if self.url_dict['platformname'] == 'Sentinel-5':
-            shutil.copyfile(tmp_bytes_path, self.load_path + name + '.nc')
-        else:
-            self.unzip_and_save_timeout(loaded, self.load_path)
+            with self.metrics.timer('extract', uuid):
+                self.move_and_save(loaded, os.path.join(unzip_path, name + '.nc'))
+            if self.db:  # the tmp file was renamed, there is nothing to resume
+                self.db.delete_checksums(os.path.abspath(loaded.path))
+            return self._extracted(uuid, self._stored(uuid, unzip_path, name + '.nc', loaded.digests['md5']))
+        if self.extractor is not None:
+            return self.extractor.submit(extract_zip, loaded.path, unzip_path, self.members,
+                                         then=lambda folder: self._extracted(
+                                             uuid, self._stored(uuid, unzip_path, folder, loaded.digests['md5']),
+                                             loaded.path),
+                                         timer=lambda seconds: self.metrics.observe('extract', seconds, uuid),
+                                         waited=lambda seconds: self.metrics.observe('backpressure_wait', seconds))
+        with self.metrics.timer('extract', uuid):
+            folder = self.unzip_and_save_timeout(loaded, unzip_path, self.members)
+        return self._extracted(uuid, self._stored(uuid, unzip_path, folder, loaded.digests['md5']), loaded.path)
+
+    def _unzip_path(self, uuid, checksum=None):
+        """ products are extracted into the store if there is one, then linked into load_path """
+        if self.store is None:
+            return self.load_path
+        return self.store.folder(uuid, checksum, self.members)
+
+    def _stored(self, uuid, unzip_path, entry, checksum=None):
+        """ records the product extracted into the store and links it into load_path, returns `entry` """
+        if self.store is not None:
+            self.store.add(uuid, self.members, os.path.join(unzip_path, entry), checksum)
+            self.store.materialize(uuid, self.members, self.load_path)
+        return entry
+
+    def load_members(self, uuid):
+        """
+        Only `members` are fetched: the central directory of the remote zip is read with Range requests,
+        then the selected members. There is no md5 of the whole zip, the members are checked by their CRC-32.
+        Returns None if the hub doesn't support Range requests
+        """
+        url_download = self.url_dict['url_download'].format(uuid)
+        logger.info('Started loading members of {}'.format(uuid))
+        try:
+            remote, raw = open_remote(url_download, self.url_dict['auth'], self.session, policy=self.retry_policy,
+                                      slot=lambda: self.host_limiter.slot(url_download))
+        except RangeNotSupportedError as e:
+            logger.warning('{}, loading the whole zip'.format(e))
+            return None
+        unzip_path = self._unzip_path(uuid)
+        with remote, self.metrics.timer('extract', uuid):
+            folder = extract_zip(remote, unzip_path, self.members)
+        self.metrics.count('bytes', raw.bytes_fetched, uuid)
+        logger.info('{:.1f} of {:.1f} MB of {} were loaded'.format(raw.bytes_fetched * B2MB, raw.size * B2MB, uuid))
+        self._set_state(uuid, 'verified', n_bytes=raw.bytes_fetched)
+        return self._extracted(uuid, self._stored(uuid, unzip_path, folder))
+
+    def _extracted(self, uuid, entry, tmp_bytes_path=None):
+        self.presence.add_loaded(entry)
+        if tmp_bytes_path is not None:
+            os.remove(tmp_bytes_path)
+            if self.db:
+                self.db.delete_checksums(os.path.abspath(tmp_bytes_path))
+        self._set_state(uuid, 'extracted', members=members_key(self.members))
+        return True
+
+    def _get_request(self, url, tmp_path=None, **kwargs):
+        return get_request(url, self.url_dict['auth'], tmp_path, session=self.session, policy=self.retry_policy,
+                           **kwargs)
+
+    def _tmp_bytes_path(self, uuid):
+        return os.path.join(self.tmp_path, TMP_BYTES_PREFIX + uuid)
 
     @staticmethod
-    def is_file_in(path_to_folder, full_name, cropped=False):  # match => looking ONLY from the begging
-        name_to_match = full_name
-        len_match = 1
-        if cropped:
-            name_to_match = full_name[: TYPICAL_CROPPED_LENGTH]  # we usually cut like this
-            if SLSTR_PATTERN in full_name:
-                len_match = 2  # because we have to match SLSTR_1000, SLSTR_500
-        if os.path.exists(path_to_folder):
-            match = [x for x in os.listdir(path_to_folder) if re.match(name_to_match, x)]
-            if len(match) == len_match:
-                if cropped:  # making critical logs was not the best solution but now we can see in logs
-                    logger.error('Cropped version of {} is already in {}'.format(full_name, path_to_folder))
-                else:
-                    logger.critical('Product {} was already downloaded to {}'.format(full_name, path_to_folder))
-                return True
-        return False
+    def is_file_in(path_to_folder, full_name, cropped=False):
+        """ one-off check, Loader itself uses `self.presence` which lists the folders only once """
+        presence = PresenceIndex(path_to_folder, path_to_folder)
+        return presence.is_cropped(full_name) if cropped else presence.is_loaded(full_name)
 
     def download_timeout(self,
                          uuid,
-                         tmp_bytes_path):
+                         tmp_bytes_path,
+                         size=None):
         url_download = self.url_dict['url_download'].format(uuid)
-        auth = self.url_dict['auth']
 
         # start_f = time.time()
+        loaded = self._verified_before(tmp_bytes_path)
+        if loaded is not None:
+            logger.info('{} was downloaded and verified before, check sums are not loaded'.format(uuid))
+            return loaded
         logger.info('Started downloading {}'.format(uuid))
-        loaded, tried = get_request(url_download, auth, tmp_bytes_path)
+        checksum = self._prefetch_checksum(uuid)
+        with self.scheduler.slot(size):
+            loaded, tried = self._get_request(url_download, tmp_bytes_path,
+                                              chunk_size=self.chunk_size, hash_names=self.hash_names,
+                                              throttle=self.scheduler.throttle,
+                                              slot=lambda: self.host_limiter.slot(url_download),
+                                              metrics=self.metrics.product(uuid))
 
         if loaded is None:
             logger.error('Was not able to download product {} retried {} times. Final size {} MB'.
-                         format(uuid, tried, os.path.getsize(tmp_bytes_path) * B2MB))
+                         format(uuid, tried,
+                                os.path.getsize(tmp_bytes_path) * B2MB if os.path.exists(tmp_bytes_path) else 0))
             return
 
-        if self.md5_ok(loaded, uuid):
-            logger.info('{} successfully downloaded. MD5 sums were equal'.format(uuid))
+        checksum_ok = self.md5_ok(loaded, uuid, checksum)
+        if checksum_ok:
+            logger.info('{} successfully downloaded. Check sums were equal'.format(uuid))
+            if self.db:  # a crash before the extraction doesn't cost the download
+                stat = os.stat(tmp_bytes_path)
+                self.db.insert_checksums(os.path.abspath(tmp_bytes_path), stat.st_size, stat.st_mtime_ns,
+                                         loaded.digests)
             return loaded
+        if checksum_ok is None:  # the file may be right: the next attempt checks it without downloading it again
+            loaded.partial.save()
+        else:
+            loaded.partial.discard()  # corrupted, the next attempt must not resume from it
+
+    def _verified_before(self, tmp_bytes_path):
+        """ LoadedFile if the complete tmp file was verified by a previous run and not changed since """
+        if not self.db or not os.path.isfile(tmp_bytes_path):
+            return None
+        stat = os.stat(tmp_bytes_path)
+        digests = self.db.get_checksums(os.path.abspath(tmp_bytes_path), stat.st_size, stat.st_mtime_ns)
+        if not all(hash_name in digests for hash_name in self.hash_names):
+            return None
+        return LoadedFile(tmp_bytes_path, stat.st_size, {name: digests[name] for name in self.hash_names})
+
+    def md5_ok(self, loaded, uuid, checksum=None):
+        return self._checksum_ok(loaded, uuid, 'md5', self.url_dict['url_md5'], checksum)
+
+    def _prefetch_checksum(self, uuid):
+        """ Future of (content, tried), the md5 sum is loaded while the body is streaming """
+        return self.checksum_pool.submit(self._get_checksum, self.url_dict['url_md5'].format(uuid), uuid)
+
+    def _get_checksum(self, url_checksum, uuid):
+        with self.metrics.timer('checksum', uuid):
+            return self._get_request(url_checksum)
+
+    def _checksum_ok(self, loaded, uuid, hash_name, url_template, checksum=None):
+        """
+        `loaded` was hashed while streaming (get_request.LoadedFile), so only the digests are compared.
+        `checksum` is a Future from _prefetch_checksum, otherwise the sum is loaded now.
+        Returns None if the sum was not loaded
+        """
+        logger.debug('Started {} for {}'.format(hash_name, uuid))
+        if checksum is None:
+            checksum_content, tried = self._get_checksum(url_template.format(uuid), uuid)
+        else:
+            checksum_content, tried = checksum.result()
 
-    def md5_ok(self, loaded_content, uuid):
-        url_md5 = self.url_dict['url_md5'].format(uuid)
-        logger.debug('Started MD5 for {}'.format(uuid))
-
-        md5_content, tried = get_request(url_md5, self.url_dict['auth'])
-
-        if md5_content is None:
-            logger.fatal('MD5 sums were not downloaded after {} attempts'.format(tried))
-            return False
+        if checksum_content is None:
+            logger.fatal('{} sums were not downloaded after {} attempts'.format(hash_name, tried))
+            return None
 
-        loaded_md5 = hashlib.md5(loaded_content).hexdigest()
-        expected_md5 = md5_content.decode('utf-8').lower()
+        expected = checksum_content.decode('utf-8').strip().lower()
 
-        if loaded_md5 != expected_md5:
-            logger.fatal('MD5 sums were not equal for {}'.format(uuid))
+        if loaded.digests[hash_name] != expected:
+            logger.fatal('{} sums were not equal for {}'.format(hash_name, uuid))
             return False
         return True
 
     @staticmethod
-    def unzip_and_save_timeout(download_request_content, unzip_path):
-        z = zipfile.ZipFile(io.BytesIO(download_request_content))
-        z.extractall(unzip_path)
-        name = z.namelist()[0][:-1]  # name of the folder + remove slash at the end
-        logger.info(f'SUCCESSFULLY UNZIPPED AND SAVED \n {name} in {unzip_path}')
+    def unzip_and_save_timeout(loaded, unzip_path, members=None):
+        """ members (all or matching `members` globs) are streamed from the tmp file, returns the root folder """
+        return extract_zip(loaded.path, unzip_path, members)
+
+    @staticmethod
+    def move_and_save(loaded, save_path):
+        """ single-file products (Sentinel-5) are renamed instead of copied """
+        os.makedirs(os.path.dirname(os.path.abspath(save_path)), exist_ok=True)
+        try:
+            os.replace(loaded.path, save_path)
+        except OSError:  # tmp and load paths are on different devices
+            shutil.move(loaded.path, save_path + PART_SUFFIX)
+            os.replace(save_path + PART_SUFFIX, save_path)
+        logger.info(f'SUCCESSFULLY SAVED \n {save_path}')
 
     def query_copernicus(self,
                          polygon='Nederland 2deg',  # or wkt
                          period=("2018-04-01", "2018-04-01")):
-        results = {'uuids': [],
-                   'names': [],
-                   'dates': [],
-                   'sizes': [],
-                   'n_images': 0,
-                   'clouds': [],
-                   'i_clouded': []}
-
-        url_search = self.url_dict['url_search']
-
         date_start, date_end = self.__parse_period(period)
         if self.db:
             wkt = self.__parse_polygon(polygon)
@@ -191,6 +525,38 @@ class Loader:
             logger.warning('Database was not selected so use wkt instead of a polygon name')
             wkt = polygon
 
+        if not self.db or not self.cache_ttl:
+            return self._query_hub(wkt, date_start, date_end)[0]
+        return self._query_cached(wkt, date_start, date_end)
+
+    def _query_cached(self, wkt, date_start, date_end):
+        """
+        Only the days not searched during `cache_ttl` go to the hub, the rest comes from the query table.
+        The last QUERY_CACHE_SETTLE_DAYS are never marked as searched: the hub is still ingesting them.
+        Days searched for a polygon containing `wkt` (f.e. the whole region of tiled sub-AOIs) are covered too,
+        their products are taken if the footprints intersect `wkt`
+        """
+        pol_id = self.db.get_pol_id(wkt)
+        platform = self.url_dict['platformname']
+        containing = self.db.get_containing_polygons(wkt)
+        gaps = self.db.get_uncovered([pol_id] + containing, platform, self.query_key, date_start, date_end,
+                                     self.cache_ttl)
+        if not gaps:
+            logger.info('Query for {} - {} was answered from the database'.format(date_start, date_end))
+        settled = (date.today() - timedelta(days=QUERY_CACHE_SETTLE_DAYS)).isoformat()
+        for gap_start, gap_end in gaps:
+            logger.info('Searching the hub for {} - {}'.format(gap_start, gap_end))
+            products, complete = self._query_hub(wkt, gap_start, gap_end)
+            if complete and gap_start <= settled:
+                self.db.insert_coverage(pol_id, platform, self.query_key, gap_start, min(gap_end, settled))
+        return self.db.get_products(pol_id, platform, self.producttype, date_start, date_end, containing, wkt)
+
+    def _query_hub(self, wkt, date_start, date_end):
+        """ returns ([Product], True if all the pages were loaded) """
+        products = []
+
+        url_search = self.url_dict['url_search']
+
         query = self.query_template.format(polygon=wkt,
                                            date_start=date_start,
                                            date_end=date_end,
@@ -199,32 +565,41 @@ class Loader:
         start = 0
         search = url_search + query.format(start=start)
         # content, tried = self.get_request(search, 'query')
-        content, tried = get_request(search, self.url_dict['auth'])
+        with self.metrics.timer('search_page'):
+            content, tried = self._get_request(search)
 
         if content is None:
             logger.error('Failed to get query {} after {} attempts'.format(query, tried))
-            return results
-        else:
-            # request_text = r.text
-            request_text = content.decode('utf-8')
+            return products, False
 
-        if re.findall(RE_NO_RESULTS, request_text):
+        n_images, products = parse_page(content)
+        if n_images == 0:
             logger.warning('Query returned no results.\n{}'.format(query))
         else:
-            n_images = int(re.search(RE_N_IMAGES, request_text).group())
             logger.debug('Found {} images'.format(n_images))
-            while n_images - start > 0:
-                start += MAX_REQUEST_N_IMAGES
-                search = url_search + query.format(start=start)
-                content, _ = get_request(search, self.url_dict['auth'])
-                request_text += content.decode('utf-8')
-            results = self.__parse_request_response(request_text)
-            results['i_clouded'], results['clouds'] = self._find_clouds_s2(request_text)
-            results['n_images'] = n_images
+            # all the offsets are known after the first page, so the rest of pages are loaded in parallel
+            offsets = range(MAX_REQUEST_N_IMAGES, n_images, MAX_REQUEST_N_IMAGES)
+            pages = map_ordered(lambda offset: self._get_page(url_search + query, offset), offsets, SEARCH_WORKERS)
+            for page in pages:
+                if page is not None:
+                    products.extend(page)
+            if len(products) != n_images:
+                logger.error('Only {} of {} images were found, some pages failed'.format(len(products), n_images))
             if self.db:
                 pol_id = self.db.get_pol_id(wkt)
-                self.db.insert_query(self.url_dict, results, pol_id, self.producttype)
-        return results
+                self.db.insert_query(self.url_dict, products, pol_id, self.producttype)
+        return products, len(products) >= n_images
+
+    def _get_page(self, search_template, start):
+        """ every page is retried on its own and parsed to [Product], a failed page is returned as None """
+        search = search_template.format(start=start)
+        for _ in range(PAGE_RETRIES):
+            with self.metrics.timer('search_page'):
+                content, tried = self._get_request(search)
+            if content is not None:
+                return parse_page(content)[1]
+            logger.warning('Failed to get page starting from {} after {} attempts'.format(start, tried))
+        logger.error('Page starting from {} is skipped'.format(start))
 
     @staticmethod
     def __parse_period(period):
@@ -254,46 +629,9 @@ class Loader:
                                 .format(polygon))
         return wkt
 
-    @staticmethod
-    def __parse_request_response(request_text):
-        results = {
-            'dates': re.findall(RE_DATE, request_text),
-            'uuids': re.findall(REGEX.format('uuid'), request_text),
-            'names': re.findall(REGEX.format('identifier'), request_text),
-            'sizes': re.findall(REGEX.format('size'), request_text)
-        }
-        return results
-
-    def _find_clouds_s2(self, r_text):
-        clouds = []
-        i_clouded = []
-        if self.url_dict['platformname'] == 'Sentinel-2':
-            clouds = re.findall(RE_S2_CLOUDS, r_text)
-            i_clouded = [i for i, x in enumerate(clouds) if float(x) > MAX_CLOUD_COVER]  # didn't want numpy
-            logger.info('{} overcast images (> {}%) were found and will not be downloaded'
-                        .format(len(i_clouded), MAX_CLOUD_COVER))
-        return i_clouded, clouds
-
 
 if __name__ == '__main__':
-    """ for Sentinel-1 and 2 provide your credential in auth=('user', 'pwd')"""
-    load_path_dir = r'./'
-    # os.chdir(load_path)
-    if args.database:
-        db = LoaderDB('loader.db')
-    else:
-        db = LoaderDB(':memory:')
-
-    loader = Loader(platform_name='Sentinel-3',
-                    load_path=load_path_dir,
-                    auth=args.a[0],
-                    loader_db=db,
-                    product_type_or_level=None)
-
-    # print(os.getcwd())
-    # if args.query:
-    #     # results = loader.query_copernicus(polygon='Majadas EC', period=('2017-04-01', '2018-08-30'))
-    #     print(loader.query_copernicus())
-    # else:
-    #     # loader.download(polygon='Majadas EC', period=('2017-04-01', '2018-04-01'))
-    #     loader.download(polygon='Majadas EC', period=('2017-04-01', '2018-04-01'))
+    """ for Sentinel-1 and 2 provide your credential in -a user password """
+    import sys
+    from cli import main
+    sys.exit(main())
@@ -1,4 +1,12 @@
 import sqlite3
+import threading
+import time
+from contextlib import nullcontext
+from datetime import date, datetime, timedelta
+from itertools import islice
+
+import geometry
+from opensearch import format_date, parse_date, parse_size, Product
 
 import logging
 # # if you want to control logs uncomment all lines
@@ -7,21 +15,136 @@ import logging
 logger = logging.getLogger()
 
 
+DOWNLOAD_STATES = ('pending', 'in_progress', 'verified', 'extracted', 'failed')
+STATE_BATCH = 50
+STATE_FLUSH_INTERVAL = 5  # s
+# scheduler.ORDERINGS in SQL
+CLAIM_ORDERS = {
+    'queue': 'id',
+    'smallest': 'size IS NULL, size, id',
+    'newest': 'date IS NULL, date DESC, id',
+    'date': 'date IS NULL, date, id',
+}
+LOCK_TIMEOUT = 60  # s to wait for other processes writing to the same database
+INSERT_CHUNK = 5000  # rows per transaction of bulk inserts, other writers get the lock between chunks
+FETCH_ROWS = 1000  # rows read at a time by find_products
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_timestamp(value):
+    """ naive UTC datetime or date -> seconds since EPOCH, dates are stored so """
+    if value is None:
+        return None
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    return (value - EPOCH).total_seconds()
+
+
+def from_timestamp(seconds):
+    return EPOCH + timedelta(seconds=seconds) if seconds is not None else None
+
+
+def _day_timestamp(day, days=0):
+    """ 'YYYY-mm-dd' + `days` -> timestamp of its midnight """
+    return to_timestamp(date.fromisoformat(day) + timedelta(days=days))
+
+
+def _overlap_params(polygons):
+    """ parameters of `max_x >= ? AND min_x <= ? AND max_y >= ? AND min_y <= ?`: boxes overlapping `polygons` """
+    min_x, max_x, min_y, max_y = geometry.bbox(polygons)
+    return [min_x, max_x, min_y, max_y]
+
+
+def _chunks(rows, size=INSERT_CHUNK):
+    rows = iter(rows)
+    chunk = list(islice(rows, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(rows, size))
+
+
 class LoaderDB:
     """
-    Has 2 tables to keep track of done things (query) and to store wkt of polygons, accessible by name (polygons)
+    Results of the queries are kept in products (one typed row per uuid: date in seconds since EPOCH, size in
+    bytes, clouds in % or NULL), product_types and query (which products were found for which polygon),
+    polygons stores wkt of polygons, accessible by name.
+    query_coverage remembers which date windows were already fully searched, so `query` works as a cache.
+    downloads is the queue of products to load with their state (see DOWNLOAD_STATES), several processes or hosts
+    sharing one database claim products from it under a lease (see claim_downloads).
+    checksums keeps verified digests of files with their size and mtime, store the products of store.ProductStore:
+    a file which wasn't changed since is trusted without hashing it again.
+    Bounding boxes of polygons and of product footprints are kept in R*Tree indexes (polygons_rtree,
+    footprints_rtree), so an AOI within already searched polygons is answered from the database.
+    Every thread reads through its own connection (':memory:' has a single one, used under a lock).
+    WAL doesn't work on network file systems, use `wal=False` for a database shared over a network volume
     """
-    def __init__(self, db_path):
-        self.conn = sqlite3.connect(db_path)
-        self.c = self.conn.cursor()
+    def __init__(self, db_path, wal=True):
+        self.db_path = db_path
+        self.wal = wal and db_path != ':memory:'
+        self._lock = threading.RLock()  # writes of this process go one by one
+        self._local = threading.local()
+        self._connections = []
+        # an in-memory database exists only for its connection, it is shared by all the threads
+        self._shared = self._connect() if db_path == ':memory:' else None
+        self._read_lock = self._lock if self._shared is not None else nullcontext()
+        if self.wal:
+            self.conn.execute('PRAGMA journal_mode=WAL')  # readers don't wait for state updates
+        self._states = []  # buffered state transitions
+        self._states_flushed_at = time.time()
+        self._type_ids = {}
         # initialization of tables
         self._create_polygons_table()
+        self._create_rtree('polygons_rtree')
+        self._index_polygons()
         self._insert_known_polygons()
         self._create_query_table()
+        self._create_footprints_table()
+        self._migrate_query_table()
+        self._create_query_coverage_table()
+        self._create_downloads_table()
+        self._create_metrics_table()
+        self._create_checksums_table()
+        self._create_store_table()
+
+    def _connect(self):
+        # connections are closed by close() or, once their thread has finished, by the next _connect()
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=LOCK_TIMEOUT)
+        if self.wal:
+            conn.execute('PRAGMA synchronous=NORMAL')
+        with self._lock:
+            alive = []
+            for thread, other in self._connections:
+                if thread is None or thread.is_alive():
+                    alive.append((thread, other))
+                else:
+                    other.close()
+            # the shared in-memory connection outlives the thread which opened it
+            alive.append((None if self.db_path == ':memory:' else threading.current_thread(), conn))
+            self._connections = alive
+        return conn
+
+    @property
+    def conn(self):
+        """ connection of the calling thread """
+        if self._shared is not None:
+            return self._shared
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def close(self):
+        with self._lock:
+            if self._states:
+                self.flush_download_states()
+            for _, conn in self._connections:
+                conn.close()
+            self._connections = []
+            self._local = threading.local()
 
     def _create_polygons_table(self):
         with self.conn:
-            self.c.execute(
+            self.conn.execute(
                 """
                 CREATE TABLE IF NOT EXISTS polygons 
                 (
@@ -32,30 +155,242 @@ class LoaderDB:
                 )
                 """
             )
+            self.conn.execute('CREATE INDEX IF NOT EXISTS polygons_name ON polygons (polygon_name)')
 
     def _create_query_table(self):
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(query)')]
+        with self.conn:
+            if 'uuid' in columns:  # a row per (polygon, product) with TEXT dates and sizes of older versions
+                self.conn.execute('ALTER TABLE query RENAME TO query_v0')
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS product_types
+                (
+                type_id INTEGER PRIMARY KEY,
+                platformname TEXT,
+                level_or_type TEXT,
+                CONSTRAINT unq UNIQUE (platformname, level_or_type)
+                )
+                """
+            )
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS products
+                (
+                id INTEGER PRIMARY KEY,
+                uuid TEXT UNIQUE,
+                full_name TEXT,
+                type_id INT REFERENCES product_types (type_id),
+                date REAL,
+                size INTEGER,
+                clouds REAL
+                )
+                """
+            )
+            self.conn.execute('CREATE INDEX IF NOT EXISTS products_type_date ON products (type_id, date)')
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS query
+                (
+                pol_id INT REFERENCES polygons (pol_id),
+                product_id INT REFERENCES products (id),
+                PRIMARY KEY (pol_id, product_id)
+                ) WITHOUT ROWID
+                """
+            )
+
+    def _migrate_query_table(self):
+        """ rows of query_v0 (see _create_query_table) go to products and query, then query_v0 is dropped """
+        if not self.conn.execute("SELECT name FROM sqlite_master WHERE name = 'query_v0'").fetchone():
+            return
+        rows = self.conn.execute(
+            """
+            SELECT platformname, level_or_type, date, uuid, full_name, size, clouds, pol_id
+            FROM query_v0
+            ORDER BY id
+            """
+        ).fetchall()
+        by_type = {}
+        for platformname, level_or_type, product_date, uuid, name, size, clouds, pol_id in rows:
+            if isinstance(size, str):  # '28.04 MB' of the first versions or a number as TEXT
+                size = int(size) if size.isdigit() else parse_size(size)
+            product = Product(uuid, name, parse_date(product_date) if product_date else None, size=size,
+                              clouds=clouds if clouds != 'null' else None)
+            by_type.setdefault((platformname, level_or_type), {}).setdefault(pol_id, []).append(product)
+        for (platformname, level_or_type), by_polygon in by_type.items():
+            for pol_id, products in by_polygon.items():
+                self.insert_query({'platformname': platformname}, products, pol_id, level_or_type)
+        with self._lock, self.conn:
+            self.conn.execute('DROP TABLE query_v0')
+        logger.info('{} rows of the query table are migrated to products'.format(len(rows)))
+
+    def _create_rtree(self, name):
+        with self.conn:
+            try:
+                self.conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS {} USING rtree (id, min_x, max_x, min_y, max_y)'
+                                  .format(name))
+            except sqlite3.OperationalError:  # sqlite3 without R*Tree module, the same queries on a plain table
+                logger.warning('SQLite has no R*Tree module, {} is a plain table'.format(name))
+                self.conn.execute('CREATE TABLE IF NOT EXISTS {} (id INTEGER PRIMARY KEY, '
+                                  'min_x REAL, max_x REAL, min_y REAL, max_y REAL)'.format(name))
+
+    def _create_footprints_table(self):
         with self.conn:
-            self.c.execute(
+            self.conn.execute(
                 """
-                CREATE TABLE IF NOT EXISTS query 
+                CREATE TABLE IF NOT EXISTS footprints
                 (
                 id INTEGER PRIMARY KEY,
+                uuid TEXT UNIQUE,
+                wkt TEXT
+                )
+                """
+            )
+        self._create_rtree('footprints_rtree')
+
+    def _index_polygons(self):
+        """ polygons inserted by older versions get their bounding boxes """
+        rows = self.conn.execute(
+            """
+            SELECT pol_id, wkt
+            FROM polygons
+            WHERE pol_id NOT IN (SELECT id FROM polygons_rtree)
+            """
+        ).fetchall()
+        with self._lock, self.conn:
+            for pol_id, wkt in rows:
+                self._insert_bbox('polygons_rtree', pol_id, wkt)
+
+    def _insert_bbox(self, rtree, row_id, wkt):
+        polygons = geometry.parse_wkt(wkt)
+        if polygons:
+            self.conn.execute('INSERT OR REPLACE INTO {} VALUES (?, ?, ?, ?, ?)'.format(rtree),
+                              (row_id, ) + geometry.bbox(polygons))
+
+    def _create_query_coverage_table(self):
+        with self.conn:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS query_coverage
+                (
+                id INTEGER PRIMARY KEY,
+                pol_id INT REFERENCES polygons (pol_id),
                 platformname TEXT,
                 level_or_type TEXT,
-                date TEXT,
+                date_start TEXT,
+                date_end TEXT,
+                queried_at REAL
+                )
+                """
+            )
+            self.conn.execute('CREATE INDEX IF NOT EXISTS query_coverage_polygon '
+                              'ON query_coverage (pol_id, platformname, level_or_type)')
+
+    def _create_downloads_table(self):
+        with self.conn:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS downloads
+                (
+                id INTEGER PRIMARY KEY,
                 uuid TEXT,
                 full_name TEXT,
-                size TEXT, 
-                clouds REAL, 
-                pol_id INT REFERENCES polygons (pol_id),
-                CONSTRAINT unq UNIQUE (pol_id, uuid)
+                platformname TEXT,
+                load_path TEXT,
+                state TEXT DEFAULT 'pending',
+                attempts INT DEFAULT 0,
+                bytes INT,
+                error TEXT,
+                enqueued_at REAL,
+                started_at REAL,
+                finished_at REAL,
+                lease_owner TEXT,
+                lease_expires REAL,
+                size INT,
+                date TEXT,
+                members TEXT,
+                CONSTRAINT unq UNIQUE (uuid, load_path)
                 )
                 """
             )
+            columns = [row[1] for row in self.conn.execute('PRAGMA table_info(downloads)')]
+            for column, column_type in (('lease_owner', 'TEXT'), ('lease_expires', 'REAL'),
+                                        ('size', 'INT'), ('date', 'TEXT'), ('members', 'TEXT')):
+                if column not in columns:  # downloads table created by older versions
+                    self.conn.execute('ALTER TABLE downloads ADD COLUMN {} {}'.format(column, column_type))
+            self.conn.execute('CREATE INDEX IF NOT EXISTS downloads_state ON downloads (load_path, state)')
 
-    def insert_polygon(self, wkt, name=""):
+    def _create_metrics_table(self):
+        with self.conn:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS metrics
+                (
+                id INTEGER PRIMARY KEY,
+                run_id TEXT,
+                uuid TEXT,
+                name TEXT,
+                value REAL
+                )
+                """
+            )
+            self.conn.execute('CREATE INDEX IF NOT EXISTS metrics_run ON metrics (run_id)')
+
+    def _create_checksums_table(self):
         with self.conn:
-            self.c.execute(
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS checksums
+                (
+                path TEXT,
+                hash_name TEXT,
+                digest TEXT,
+                size INTEGER,
+                mtime_ns INTEGER,
+                verified_at REAL,
+                PRIMARY KEY (path, hash_name)
+                )
+                """
+            )
+
+    def _create_store_table(self):
+        with self.conn:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS store
+                (
+                uuid TEXT,
+                members TEXT,
+                path TEXT,
+                checksum TEXT,
+                size INTEGER,
+                mtime_ns INTEGER,
+                stored_at REAL,
+                PRIMARY KEY (uuid, members)
+                )
+                """
+            )
+
+    def insert_metrics(self, rows, run_id=None):
+        """
+        rows of (run_id, uuid, name, value), see metrics.RunMetrics.
+        The rows written before for `run_id` are replaced: a campaign exports its metrics after every job
+        """
+        with self._lock, self.conn:
+            if run_id is not None:
+                self.conn.execute('DELETE FROM metrics WHERE run_id = ?', (run_id, ))
+            self.conn.executemany(
+                """
+                INSERT INTO metrics
+                (run_id, uuid, name, value)
+                VALUES (?, ?, ?, ?)
+                """,
+                rows
+            )
+
+    def insert_polygon(self, wkt, name=""):
+        with self._lock, self.conn:
+            cursor = self.conn.execute(
                 """
                 INSERT OR IGNORE INTO polygons 
                 (wkt, polygon_name) 
@@ -63,35 +398,462 @@ class LoaderDB:
                 """,
                 (wkt, name)
             )
+            if cursor.rowcount:
+                self._insert_bbox('polygons_rtree', cursor.lastrowid, wkt)
 
-    def insert_query(self, url_dict, results, pol_id, product_type_or_level):
-        length = results['n_images']
-        platforms = [url_dict['platformname']] * length  # list of repeats
-        levels = [product_type_or_level] * length
-        pol_ids = [pol_id] * length
-        if len(results['clouds']) == 0:  # `not results['clouds']` is not clear enough
-            results['clouds'] = ['null'] * length
-        with self.conn:
-            self.c.executemany(
+    def _get_type_id(self, platformname, product_type_or_level):
+        key = platformname, product_type_or_level
+        if key not in self._type_ids:
+            with self._lock, self.conn:
+                self.conn.execute('INSERT OR IGNORE INTO product_types (platformname, level_or_type) VALUES (?, ?)',
+                                  key)
+                self._type_ids[key] = self.conn.execute(
+                    'SELECT type_id FROM product_types WHERE platformname = ? AND level_or_type = ?', key
+                ).fetchone()[0]
+        return self._type_ids[key]
+
+    def insert_query(self, url_dict, products, pol_id, product_type_or_level):
+        """ `products` are opensearch.Product records, written by INSERT_CHUNK in a transaction """
+        type_id = self._get_type_id(url_dict['platformname'], product_type_or_level)
+        for chunk in _chunks(products):
+            with self._lock, self.conn:
+                self.conn.executemany(
+                    """
+                    INSERT OR IGNORE INTO products
+                    (uuid, full_name, type_id, date, size, clouds)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    """,
+                    ((p.uuid, p.name, type_id, to_timestamp(p.date), p.size, p.clouds) for p in chunk)
+                )
+                self.conn.executemany(
+                    """
+                    INSERT OR IGNORE INTO query
+                    (pol_id, product_id)
+                    SELECT ?, id FROM products WHERE uuid = ?
+                    """,
+                    ((pol_id, p.uuid) for p in chunk)
+                )
+                for p in chunk:
+                    if p.footprint:
+                        cursor = self.conn.execute('INSERT OR IGNORE INTO footprints (uuid, wkt) VALUES (?, ?)',
+                                                   (p.uuid, p.footprint))
+                        if cursor.rowcount:
+                            self._insert_bbox('footprints_rtree', cursor.lastrowid, p.footprint)
+
+    def insert_coverage(self, pol_id, platformname, product_type_or_level, date_start, date_end):
+        """ dates are inclusive 'YYYY-mm-dd' """
+        with self._lock, self.conn:
+            self.conn.execute(
+                """
+                INSERT INTO query_coverage
+                (pol_id, platformname, level_or_type, date_start, date_end, queried_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (pol_id, platformname, product_type_or_level, date_start, date_end, time.time())
+            )
+
+    def get_uncovered(self, pol_id, platformname, product_type_or_level, date_start, date_end, ttl):
+        """
+        Returns [(date_start, date_end)] sub-ranges of the period that were not searched during last `ttl` seconds.
+        `pol_id` may be a list: a day searched for any of the polygons is covered (see get_containing_polygons)
+        """
+        pol_ids = list(pol_id) if isinstance(pol_id, (list, tuple)) else [pol_id]
+        with self._read_lock:
+            rows = self.conn.execute(
+                """
+                SELECT date_start, date_end
+                FROM query_coverage
+                WHERE pol_id IN ({}) AND platformname = ? AND level_or_type = ? AND queried_at >= ?
+                      AND date_start <= ? AND date_end >= ?
+                ORDER BY date_start
+                """.format(', '.join('?' * len(pol_ids))),
+                pol_ids + [platformname, product_type_or_level, time.time() - ttl, date_end, date_start]
+            ).fetchall()
+        gaps = []
+        next_day = date.fromisoformat(date_start)
+        last_day = date.fromisoformat(date_end)
+        for covered_start, covered_end in rows:
+            covered_start = date.fromisoformat(covered_start)
+            if covered_start > next_day:
+                gaps.append((next_day, min(covered_start - timedelta(days=1), last_day)))
+            next_day = max(next_day, date.fromisoformat(covered_end) + timedelta(days=1))
+        if next_day <= last_day:
+            gaps.append((next_day, last_day))
+        return [(start.isoformat(), end.isoformat()) for start, end in gaps]
+
+    def get_products(self, pol_id, platformname, product_type_or_level, date_start, date_end, containing=(),
+                     wkt=None):
+        """
+        Stored results of the queries as opensearch.Product, ordered by date.
+        Products found for the `containing` polygons are added if their footprints intersect `wkt`
+        (products stored without a footprint are added as the hub would give them too)
+        """
+        start, end = _day_timestamp(date_start), _day_timestamp(date_end, 1)
+        with self._read_lock:
+            rows = self.conn.execute(
+                """
+                SELECT p.uuid, p.full_name, p.date, p.size, p.clouds, f.wkt
+                FROM query q
+                     JOIN products p ON p.id = q.product_id
+                     JOIN product_types t ON t.type_id = p.type_id
+                     LEFT JOIN footprints f ON f.uuid = p.uuid
+                WHERE q.pol_id = ? AND t.platformname = ? AND t.level_or_type = ? AND p.date >= ? AND p.date < ?
+                """,
+                (pol_id, platformname, product_type_or_level, start, end)
+            ).fetchall()
+        rows = {row[0]: row for row in rows}
+        if containing and wkt:
+            aoi = geometry.parse_wkt(wkt)
+            pol_ids = list(containing)
+            with self._read_lock:
+                found = self.conn.execute(
+                    """
+                    SELECT p.uuid, p.full_name, p.date, p.size, p.clouds, f.wkt
+                    FROM query q
+                         JOIN products p ON p.id = q.product_id
+                         JOIN product_types t ON t.type_id = p.type_id
+                         LEFT JOIN footprints f ON f.uuid = p.uuid
+                    WHERE q.pol_id IN ({}) AND t.platformname = ? AND t.level_or_type = ? AND p.date >= ? AND p.date < ?
+                          AND (f.id IS NULL OR f.id IN (SELECT id FROM footprints_rtree
+                                                        WHERE max_x >= ? AND min_x <= ? AND max_y >= ? AND min_y <= ?))
+                    """.format(', '.join('?' * len(pol_ids))),
+                    pol_ids + [platformname, product_type_or_level, start, end] + _overlap_params(aoi)
+                ).fetchall()
+            for row in found:
+                if row[0] in rows:
+                    continue
+                footprint = row[5] and geometry.parse_wkt(row[5])
+                if not footprint or geometry.intersects(footprint, aoi):
+                    rows[row[0]] = row
+        return [Product(uuid, name, from_timestamp(product_date), size=size, clouds=clouds, footprint=footprint)
+                for uuid, name, product_date, size, clouds, footprint in sorted(rows.values(), key=lambda r: r[2])]
+
+    def find_products(self, platformname=None, product_type_or_level=None, wkt=None, date_start=None,
+                      date_end=None, clouds=None, min_size=None, max_size=None, limit=None):
+        """
+        Generator of stored products (opensearch.Product) ordered by date, read FETCH_ROWS rows at a time.
+        Days are inclusive 'YYYY-mm-dd', `clouds` is (min, max) %, sizes are in bytes, None is any.
+        Products without a field pass its filter, as in filters.FilterSpec. With `wkt` products whose footprints
+        intersect it (and products without a footprint) are given with their footprints
+        """
+        clauses, params = [], []
+        for clause, value in (('t.platformname = ?', platformname),
+                              ('t.level_or_type = ?', product_type_or_level),
+                              ('p.date >= ?', date_start and _day_timestamp(date_start)),
+                              ('p.date < ?', date_end and _day_timestamp(date_end, 1)),
+                              ('(p.size IS NULL OR p.size >= ?)', min_size),
+                              ('(p.size IS NULL OR p.size <= ?)', max_size)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        if clouds is not None:
+            clauses.append('(p.clouds IS NULL OR p.clouds BETWEEN ? AND ?)')
+            params.extend(clouds)
+        aoi = None
+        if wkt:
+            aoi = geometry.parse_wkt(wkt)
+            clauses.append('(f.id IS NULL OR f.id IN (SELECT id FROM footprints_rtree '
+                           'WHERE max_x >= ? AND min_x <= ? AND max_y >= ? AND min_y <= ?))')
+            params.extend(_overlap_params(aoi))
+        with self._read_lock:
+            cursor = self.conn.execute(
+                """
+                SELECT p.uuid, p.full_name, p.date, p.size, p.clouds, {}
+                FROM products p
+                     JOIN product_types t ON t.type_id = p.type_id
+                     {}
+                WHERE {}
+                ORDER BY p.date
+                """.format('f.wkt' if aoi else 'NULL', 'LEFT JOIN footprints f ON f.uuid = p.uuid' if aoi else '',
+                           ' AND '.join(clauses) or '1'),
+                params
+            )
+        found = 0
+        while limit is None or found < limit:
+            with self._read_lock:
+                rows = cursor.fetchmany(FETCH_ROWS)
+            if not rows:
+                break
+            for uuid, name, product_date, size, product_clouds, footprint in rows:
+                if footprint:
+                    footprint_polygons = geometry.parse_wkt(footprint)
+                    if footprint_polygons and not geometry.intersects(footprint_polygons, aoi):
+                        continue
+                yield Product(uuid, name, from_timestamp(product_date), size=size, clouds=product_clouds,
+                              footprint=footprint)
+                found += 1
+                if found == limit:
+                    break
+        cursor.close()
+
+    def get_containing_polygons(self, wkt):
+        """ pol_ids of other polygons which contain `wkt` (boundaries may touch) """
+        aoi = geometry.parse_wkt(wkt)
+        if not aoi:
+            return []
+        min_x, max_x, min_y, max_y = geometry.bbox(aoi)
+        with self._read_lock:
+            rows = self.conn.execute(
+                """
+                SELECT p.pol_id, p.wkt
+                FROM polygons_rtree r JOIN polygons p ON p.pol_id = r.id
+                WHERE r.min_x <= ? AND r.max_x >= ? AND r.min_y <= ? AND r.max_y >= ? AND p.wkt != ?
+                """,
+                (min_x, max_x, min_y, max_y, wkt)
+            ).fetchall()
+        containing = []
+        for pol_id, polygon_wkt in rows:
+            polygon = geometry.parse_wkt(polygon_wkt)
+            if polygon and geometry.contains(polygon, aoi):
+                containing.append(pol_id)
+        return containing
+
+    def enqueue_downloads(self, products, platformname, load_path, members=None):
+        """
+        products which are already in the queue keep their state, `members` is the key of the extracted members
+        (see store.members_key)
+        """
+        with self._lock, self.conn:
+            self.conn.executemany(
+                """
+                INSERT OR IGNORE INTO downloads
+                (uuid, full_name, platformname, load_path, enqueued_at, size, date, members)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                ((p.uuid, p.name, platformname, load_path, time.time(), p.size,
+                  format_date(p.date) if p.date else None, members) for p in products)
+            )
+
+    def requeue_extracted(self, platformname, load_path, missing, present, members=None):
+        """
+        Extracted products go back to pending if they aren't on disk anymore (uuids in `missing`) or if they are
+        (`present`) but were extracted with other `members`. Returns uuids of the latter, to extract them again
+        """
+        changed = []
+        with self._lock, self.conn:
+            for chunk in _chunks(missing, FETCH_ROWS):
+                self.conn.execute(
+                    """
+                    UPDATE downloads
+                    SET state = 'pending', attempts = 0, error = NULL, lease_owner = NULL, members = ?
+                    WHERE platformname = ? AND load_path = ? AND state = 'extracted' AND uuid IN ({})
+                    """.format(', '.join('?' * len(chunk))),
+                    [members, platformname, load_path] + chunk
+                )
+            for chunk in _chunks(present, FETCH_ROWS):
+                rows = self.conn.execute(
+                    """
+                    SELECT uuid
+                    FROM downloads
+                    WHERE platformname = ? AND load_path = ? AND state = 'extracted'
+                          AND members IS NOT NULL AND members != ? AND uuid IN ({})
+                    """.format(', '.join('?' * len(chunk))),
+                    [platformname, load_path, members] + chunk
+                ).fetchall()
+                changed.extend(row[0] for row in rows)
+            self.conn.executemany(
+                """
+                UPDATE downloads
+                SET state = 'pending', attempts = 0, error = NULL, lease_owner = NULL, members = ?
+                WHERE platformname = ? AND load_path = ? AND uuid = ?
+                """,
+                ((members, platformname, load_path, uuid) for uuid in changed)
+            )
+        return changed
+
+    def get_download_states(self, load_path, uuids):
+        """ {uuid: (state, lease_expires)} of `uuids` in the queue of `load_path`, f.e. loaded by other workers """
+        states = {}
+        with self._read_lock:
+            for chunk in _chunks(uuids, FETCH_ROWS):
+                rows = self.conn.execute(
+                    """
+                    SELECT uuid, state, lease_expires
+                    FROM downloads
+                    WHERE load_path = ? AND uuid IN ({})
+                    """.format(', '.join('?' * len(chunk))),
+                    [load_path] + chunk
+                ).fetchall()
+                states.update((uuid, (state, lease_expires)) for uuid, state, lease_expires in rows)
+        return states
+
+    def reset_in_progress(self, platformname, load_path):
+        """ after a crash `in_progress` and `verified` (not extracted) products have to be loaded once again """
+        with self._lock, self.conn:
+            self.conn.execute(
+                """
+                UPDATE downloads
+                SET state = 'pending', lease_owner = NULL
+                WHERE platformname = ? AND load_path = ? AND state IN ('in_progress', 'verified')
+                """,
+                (platformname, load_path)
+            )
+
+    def get_queue_bytes(self, platformname, load_path, members=None):
+        """ (number, sum of sizes) of products waiting in the queue for `members` (see claim_downloads) """
+        with self._read_lock:
+            return self.conn.execute(
+                """
+                SELECT count(*), COALESCE(sum(size), 0)
+                FROM downloads
+                WHERE platformname = ? AND load_path = ? AND state IN ('pending', 'in_progress', 'verified', 'failed')
+                      AND (members IS NULL OR members = ?)
+                """,
+                (platformname, load_path, members)
+            ).fetchone()
+
+    def claim_downloads(self, platformname, load_path, owner, n, lease_seconds, max_attempts, failed_before,
+                        order='queue', members=None):
+        """
+        Atomically takes up to `n` products from the queue for `owner` until now + `lease_seconds`:
+        pending ones, in_progress or verified products with expired leases (their owner died) and failed ones
+        (with less than `max_attempts`, finished before `failed_before` - f.e. in the previous runs).
+        Only products queued with the same `members` key are taken: the others are extracted by their own jobs.
+        `order` is one of scheduler.ORDERINGS.
+        Returns [(id, uuid, full_name, size)]
+        """
+        now = time.time()
+        with self._lock:
+            self.conn.execute('BEGIN IMMEDIATE')  # takes the write lock before reading => no one claims twice
+            try:
+                claimed = self.conn.execute(
+                    """
+                    SELECT id, uuid, full_name, size
+                    FROM downloads
+                    WHERE platformname = ? AND load_path = ? AND (members IS NULL OR members = ?)
+                          AND (state = 'pending'
+                               OR (state IN ('in_progress', 'verified') AND lease_expires < ?)
+                               OR (state = 'failed' AND attempts < ? AND finished_at < ?))
+                    ORDER BY {}
+                    LIMIT ?
+                    """.format(CLAIM_ORDERS[order]),
+                    (platformname, load_path, members, now, max_attempts, failed_before, n)
+                ).fetchall()
+                self.conn.executemany(
+                    """
+                    UPDATE downloads
+                    SET state = 'in_progress', lease_owner = ?, lease_expires = ?
+                    WHERE id = ?
+                    """,
+                    ((owner, now + lease_seconds, row[0]) for row in claimed)
+                )
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+        return claimed
+
+    def renew_leases(self, owner, lease_seconds):
+        """ heartbeat of the owner, its in_progress and verified (being extracted) products are not reclaimed """
+        with self._lock, self.conn:
+            self.conn.execute(
+                """
+                UPDATE downloads
+                SET lease_expires = ?
+                WHERE lease_owner = ? AND state IN ('in_progress', 'verified')
+                """,
+                (time.time() + lease_seconds, owner)
+            )
+
+    def set_download_state(self, uuid, load_path, state, n_bytes=None, error=None, owner=None, members=None):
+        """
+        Transitions are buffered and written in one transaction every STATE_BATCH transitions or
+        STATE_FLUSH_INTERVAL seconds, call flush_download_states() at the end.
+        Only the lease owner can change the state, final states release the lease.
+        `members` is the key of the members which were extracted, None keeps the one the product was queued with
+        """
+        now = time.time()
+        started_at = now if state == 'in_progress' else None
+        finished_at = now if state in ('extracted', 'failed') else None
+        with self._lock:
+            self._states.append((state, int(state == 'in_progress'), n_bytes, error, started_at, finished_at,
+                                 members, state, uuid, load_path, owner))
+            if len(self._states) >= STATE_BATCH or now - self._states_flushed_at > STATE_FLUSH_INTERVAL:
+                self.flush_download_states()
+
+    def flush_download_states(self):
+        with self._lock, self.conn:
+            self.conn.executemany(
+                """
+                UPDATE downloads
+                SET state = ?, attempts = attempts + ?, bytes = COALESCE(?, bytes), error = ?,
+                    started_at = COALESCE(?, started_at), finished_at = ?, members = COALESCE(?, members),
+                    lease_owner = CASE WHEN ? IN ('in_progress', 'verified') THEN lease_owner END
+                WHERE uuid = ? AND load_path = ? AND (lease_owner IS NULL OR lease_owner = ?)
+                """,
+                self._states
+            )
+            self._states = []
+            self._states_flushed_at = time.time()
+
+    def insert_checksums(self, path, size, mtime_ns, digests):
+        """ `digests` {hash name: hex digest} of the file at `path` verified when it had `size` and `mtime_ns` """
+        now = time.time()
+        with self._lock, self.conn:
+            self.conn.executemany(
                 """
-                INSERT OR IGNORE INTO query
-                (platformname, level_or_type, date, uuid, full_name, size, pol_id, clouds)
-                VALUES(?, ?, ?, ?, ?, ?, ?, ?)
+                INSERT OR REPLACE INTO checksums
+                (path, hash_name, digest, size, mtime_ns, verified_at)
+                VALUES (?, ?, ?, ?, ?, ?)
                 """,
-                zip(platforms, levels, results['dates'], results['uuids'], results['names'], results['sizes'],
-                    pol_ids, results['clouds'])
+                ((path, hash_name, digest, size, mtime_ns, now) for hash_name, digest in digests.items())
             )
 
+    def get_checksums(self, path, size, mtime_ns):
+        """ {hash name: digest} verified for `path` if it has the same size and mtime, {} otherwise """
+        with self._read_lock:
+            rows = self.conn.execute(
+                """
+                SELECT hash_name, digest
+                FROM checksums
+                WHERE path = ? AND size = ? AND mtime_ns = ?
+                """,
+                (path, size, mtime_ns)
+            ).fetchall()
+        return dict(rows)
+
+    def delete_checksums(self, path):
+        with self._lock, self.conn:
+            self.conn.execute('DELETE FROM checksums WHERE path = ?', (path, ))
+
+    def insert_stored(self, uuid, members, path, checksum, size, mtime_ns):
+        """ `members` is the key of store.members_key, `size` and `mtime_ns` are of the whole tree """
+        with self._lock, self.conn:
+            self.conn.execute(
+                """
+                INSERT OR REPLACE INTO store
+                (uuid, members, path, checksum, size, mtime_ns, stored_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (uuid, members, path, checksum, size, mtime_ns, time.time())
+            )
+
+    def get_stored(self, uuid, members):
+        """ (path, checksum, size, mtime_ns) or None """
+        with self._read_lock:
+            return self.conn.execute(
+                """
+                SELECT path, checksum, size, mtime_ns
+                FROM store
+                WHERE uuid = ? AND members = ?
+                """,
+                (uuid, members)
+            ).fetchone()
+
+    def delete_stored(self, uuid, members):
+        with self._lock, self.conn:
+            self.conn.execute('DELETE FROM store WHERE uuid = ? AND members = ?', (uuid, members))
+
     def get_pol_id(self, wkt):
-        self.c.execute(
-            """
-            SELECT pol_id
-            FROM polygons
-            WHERE wkt = ?
-            """,
-            (wkt, )
-        )
-        res = self.c.fetchone()
+        with self._read_lock:
+            res = self.conn.execute(
+                """
+                SELECT pol_id
+                FROM polygons
+                WHERE wkt = ?
+                """,
+                (wkt, )
+            ).fetchone()
         if res is None:
             logger.debug('Polygon {} was not found in polygons table'.format(wkt))
         else:
@@ -99,15 +861,15 @@ class LoaderDB:
         return res
 
     def get_wkt_from_name(self, polygon_name):
-        self.c.execute(
-            """
-            SELECT wkt
-            FROM polygons
-            WHERE polygon_name = ?
-            """,
-            (polygon_name, )
-        )
-        res = self.c.fetchone()
+        with self._read_lock:
+            res = self.conn.execute(
+                """
+                SELECT wkt
+                FROM polygons
+                WHERE polygon_name = ?
+                """,
+                (polygon_name, )
+            ).fetchone()
         if res is None:
             logger.debug('Polygon {} was not found in polygons table'.format(polygon_name))
         else:
@@ -126,8 +888,17 @@ class LoaderDB:
 if __name__ == '__main__':
     db = LoaderDB('loader.db')
     db._create_polygons_table()
+    db._create_rtree('polygons_rtree')
+    db._index_polygons()
     db._insert_known_polygons()
     db._create_query_table()
+    db._create_footprints_table()
+    db._migrate_query_table()
+    db._create_query_coverage_table()
+    db._create_downloads_table()
+    db._create_metrics_table()
+    db._create_checksums_table()
+    db._create_store_table()
 
     print(db.get_pol_id("POLYGON ((3.0 54.0, 7.0 54.0, 7.0 50.0, 3.0 50.0, 3.0 54.0))"))
     print(db.get_wkt_from_name('Nederland 2deg'))
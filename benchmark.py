@@ -0,0 +1,139 @@
+"""
+Offline benchmark of the loader against fake_hub.FakeHub: throughput, latency and peak memory per stage.
+The hub runs in the same process, so peak Python memory includes its cache of product zips.
+
+    python benchmark.py --products 200 --size 20 --workers 4 --output bench.json
+    python benchmark.py --baseline bench.json  # exit code 1 if some stage got slower than the tolerance
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from fake_hub import FakeHub, FOOTPRINT
+from Loader import Loader
+from LoaderDB import LoaderDB
+
+import logging
+logger = logging.getLogger()
+
+
+B2MB = 1e-6
+PERIOD = ('2018-01-01', '2030-12-31')
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Offline benchmark with a local Copernicus hub stand-in')
+    parser.add_argument('--products', type=int, default=100, help='Number of products on the fake hub')
+    parser.add_argument('--size', type=float, default=10, help='Size of one product, MB')
+    parser.add_argument('--latency', type=float, default=0, help='Latency of every request, s')
+    parser.add_argument('--error-rate', type=float, default=0, help='Share of requests answered with 503')
+    parser.add_argument('--bandwidth', type=float, default=None, help='Limit per connection, MB/s')
+    parser.add_argument('--workers', type=int, default=4, help='Download workers of the Loader')
+    parser.add_argument('--extract-workers', type=int, default=0, help='Extract processes of the Loader')
+    parser.add_argument('--members', type=str, nargs='+', default=None, help='Globs of members to extract')
+    parser.add_argument('--remote-members', action='store_true', help='Fetch only --members with Range requests')
+    parser.add_argument('--output', type=str, default=None, help='Write the json report here')
+    parser.add_argument('--baseline', type=str, default=None, help='Json report to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed relative slowdown against the baseline. Default: 0.2')
+    return parser
+
+
+def measure(report, stage, func, n_bytes=None, n_items=None):
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+    record = {'seconds': round(seconds, 4),
+              'peak_python_mb': round(tracemalloc.get_traced_memory()[1] * B2MB, 2)}
+    if n_bytes:
+        record['mb_per_s'] = round(n_bytes * B2MB / seconds, 2)
+    if n_items:
+        record['items_per_s'] = round(n_items / seconds, 2)
+    report['stages'][stage] = record
+    logger.info('{}: {}'.format(stage, record))
+    return result
+
+
+def make_loader(hub, work_dir, workers, **kwargs):
+    loader = Loader(platform_name='Sentinel-3',
+                    load_path=os.path.join(work_dir, 'loaded') + os.sep,
+                    cropped_path=os.path.join(work_dir, 'cropped'),
+                    auth=('user', 'password'),
+                    product_type_or_level='OL_1_EFR___',
+                    loader_db=LoaderDB(':memory:'),
+                    tmp_path=os.path.join(work_dir, 'tmp'),
+                    workers=workers,
+                    max_per_host=workers,
+                    cache_ttl=0,
+                    **kwargs)
+    loader.url_dict = dict(loader.url_dict, **hub.urls())
+    return loader
+
+
+def run(args):
+    report = {'config': vars(args).copy(), 'stages': {}}
+    work_dir = tempfile.mkdtemp(prefix='loader_bench_')
+    tracemalloc.start()
+    bandwidth = args.bandwidth and args.bandwidth / B2MB
+    try:
+        with FakeHub(n_products=args.products, product_size=int(args.size / B2MB), latency=args.latency,
+                     error_rate=args.error_rate, bandwidth=bandwidth) as hub:
+            loader = make_loader(hub, work_dir, args.workers, extract_workers=args.extract_workers,
+                                 members=args.members, remote_members=args.remote_members)
+            size = hub.product_size
+
+            products = measure(report, 'query_copernicus', lambda: loader.query_copernicus(FOOTPRINT, PERIOD),
+                               n_items=args.products)
+            uuid = products[0].uuid
+            tmp_path = loader._tmp_bytes_path(uuid)
+            loaded = measure(report, 'get_request',
+                             lambda: loader._get_request(loader.url_dict['url_download'].format(uuid), tmp_path)[0],
+                             n_bytes=size)
+            measure(report, 'md5_ok', lambda: loader.md5_ok(loaded, uuid))
+            measure(report, 'unzip_and_save_timeout',
+                    lambda: loader.unzip_and_save_timeout(loaded, os.path.join(work_dir, 'unzipped')), n_bytes=size)
+            os.remove(tmp_path)
+
+            results = measure(report, 'download', lambda: loader.download(FOOTPRINT, PERIOD),
+                              n_bytes=size * args.products, n_items=args.products)
+            report['loaded'] = sum(is_loaded for _, is_loaded in results)
+            report['hub_requests'] = hub.requests
+            report['hub_mb_sent'] = round(hub.bytes_sent * B2MB, 2)
+    finally:
+        tracemalloc.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    report['max_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 * B2MB, 2)
+    return report
+
+
+def regressions(report, baseline, tolerance):
+    """ stages which are slower than in `baseline` by more than `tolerance` """
+    slower = []
+    for stage, record in report['stages'].items():
+        before = baseline['stages'].get(stage)
+        if before and record['seconds'] > before['seconds'] * (1 + tolerance):
+            slower.append('{}: {}s -> {}s'.format(stage, before['seconds'], record['seconds']))
+    return slower
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
+    args = get_parser().parse_args()
+    report = run(args)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = regressions(report, json.load(f), args.tolerance)
+        if slower:
+            print('Slower than the baseline:\n' + '\n'.join(slower))
+            sys.exit(1)
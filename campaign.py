@@ -0,0 +1,204 @@
+"""
+Many download jobs (platform x polygon x period x product type) in one process: the jobs share connections,
+the download scheduler, the database and the folder indexes, and every product is loaded once by uuid
+even if it is found by several jobs.
+
+    python campaign.py jobs.jsonl -a user password --database loader.db --jobs 4 -w 2
+
+jobs.jsonl has a json object per line, only "polygon" and "period" are required:
+
+    {"platform": "Sentinel-3", "polygon": "Nederland 2deg", "period": ["2018-04-01", "2018-04-30"],
+     "type": "OL_1_EFR___", "load_path": "./S3/", "cropped_path": "./cropped", "members": ["*radiance.nc"],
+     "filters": {"clouds": [0, 50], "newest_baseline": true}, "auth": ["user", "password"]}
+"""
+import argparse
+import json
+import sys
+
+from concurrency import HostLimiter, map_ordered, OncePerKey, MAX_PER_HOST
+from disk import DiskBudget
+from filters import default_filters
+from get_request import make_session
+from Loader import Loader
+from LoaderDB import LoaderDB
+from metrics import RunMetrics
+from presence import PresenceIndex
+from retry import UnauthorizedError
+from scheduler import DownloadScheduler, ORDERINGS
+from store import ProductStore
+from url_config import urls
+
+import logging
+logger = logging.getLogger()
+
+
+JOB_DEFAULTS = {
+    'platform': 'Sentinel-3',
+    'type': None,
+    'load_path': './',
+    'cropped_path': './cropped',
+    'members': None,
+    'filters': None,
+    'auth': None,
+}
+SEARCH_CONNECTIONS = 4
+B2MB = 1e-6
+
+
+def read_jobs(path):
+    """ [job dict with JOB_DEFAULTS], empty lines and lines starting with # are skipped """
+    jobs = []
+    with open(path) as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            job = dict(JOB_DEFAULTS, **json.loads(line))
+            if 'polygon' not in job or 'period' not in job:
+                raise ValueError('Line {} of {}: "polygon" and "period" are required'.format(n, path))
+            if job['platform'] not in urls:
+                raise ValueError('Line {} of {}: unknown platform {}'.format(n, path, job['platform']))
+            jobs.append(job)
+    return jobs
+
+
+class Campaign:
+    """
+    Runs `jobs` (see read_jobs) with `job_workers` jobs at a time, every job downloads with `workers` threads.
+    One session, HostLimiter, DownloadScheduler, RunMetrics and LoaderDB are shared by all the Loaders,
+    PresenceIndex is shared per folder, concurrency.OncePerKey makes every uuid loaded once: a job which finds
+    a product that another job loads waits for it, then it is linked into its own load_path (from the
+    `store` if there is one, see store.ProductStore, otherwise from the load_path of the other job).
+    `disk_budget` (disk.DiskBudget) admits the downloads of all the jobs
+    """
+    def __init__(self, jobs, auth, loader_db, workers=1, job_workers=1, max_per_host=MAX_PER_HOST,
+                 scheduler=None, metrics=None, tmp_path='./', shared_queue=False, store=None, disk_budget=None,
+                 **loader_kwargs):
+        self.jobs = jobs
+        self.auth = auth
+        self.db = loader_db
+        self.workers = workers
+        self.job_workers = job_workers
+        self.tmp_path = tmp_path
+        self.shared_queue = shared_queue
+        self.store = store
+        self.disk_budget = disk_budget
+        self.loader_kwargs = loader_kwargs  # the rest of Loader arguments, the same for all the jobs
+        self.session = make_session(pool_size=2 * workers * job_workers + SEARCH_CONNECTIONS)
+        self.host_limiter = HostLimiter(max_per_host)
+        self.scheduler = scheduler or DownloadScheduler()
+        self.metrics = metrics or RunMetrics()
+        self.dedup = OncePerKey()
+        self._presence = {}
+
+    def presence(self, load_path, cropped_path):
+        if (load_path, cropped_path) not in self._presence:
+            self._presence[load_path, cropped_path] = PresenceIndex(load_path, cropped_path)
+        return self._presence[load_path, cropped_path]
+
+    def make_loader(self, job):
+        filters = None
+        if job['filters'] is not None:
+            filters = default_filters(urls[job['platform']]['platformname'], **job['filters'])
+        return Loader(platform_name=job['platform'],
+                      load_path=job['load_path'],
+                      cropped_path=job['cropped_path'],
+                      auth=tuple(job['auth'] or self.auth),
+                      product_type_or_level=job['type'],
+                      loader_db=self.db,
+                      tmp_path=self.tmp_path,
+                      workers=self.workers,
+                      shared_queue=True,  # the queue of a folder is drained by all the jobs loading to it
+                      scheduler=self.scheduler,
+                      metrics=self.metrics,
+                      members=job['members'],
+                      filters=filters,
+                      session=self.session,
+                      host_limiter=self.host_limiter,
+                      presence=self.presence(job['load_path'], job['cropped_path']),
+                      dedup=self.dedup,
+                      store=self.store,
+                      disk_budget=self.disk_budget,
+                      **self.loader_kwargs)
+
+    def run(self):
+        """ [results of Loader.download or None if the job failed], in the order of jobs """
+        loaders = [self.make_loader(job) for job in self.jobs]
+        if self.db and not self.shared_queue:  # nobody else works on these queues => in_progress is left by a crash
+            for platformname, load_path in {(loader.url_dict['platformname'], loader.load_path) for loader in loaders}:
+                self.db.reset_in_progress(platformname, load_path)
+        results = map_ordered(lambda n: self._run_job(n, loaders[n]), range(len(loaders)), self.job_workers)
+        self.metrics.export()
+        return results
+
+    def _run_job(self, n, loader):
+        job = self.jobs[n]
+        period = tuple(job['period']) if isinstance(job['period'], list) else job['period']
+        logger.info('Job {}: {} {} {}'.format(n, job['platform'], job['polygon'][:40], period))
+        try:
+            results = loader.download(job['polygon'], period)
+        except UnauthorizedError:
+            logger.critical('Job {}: credentials were not accepted'.format(n))
+            return None
+        except Exception:
+            logger.exception('Job {} failed'.format(n))
+            return None
+        logger.info('Job {}: {} of {} products are on disk'.format(n, sum(loaded for _, loaded in results),
+                                                                 len(results)))
+        return results
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Runs the download jobs of a jsonl file in one process')
+    parser.add_argument('jobs', type=str, help='jsonl file, one job per line')
+    parser.add_argument('-a', metavar=('user', 'password'), type=str, nargs=2, default=('s3guest', 's3guest'),
+                        help='auth for copernicus sci.hub, jobs may have their own "auth"')
+    parser.add_argument('-t', metavar='tmp_path', type=str, default='./', help='Folder for tmp files. Default: ./')
+    parser.add_argument('--database', type=str, default=None,
+                        help='Path to LoaderDB, the queue and the query cache survive between runs')
+    parser.add_argument('--no-wal', action='store_true', help='Do not use WAL journal (network volumes)')
+    parser.add_argument('--jobs', dest='job_workers', type=int, default=2, help='Jobs at a time. Default: 2')
+    parser.add_argument('-w', metavar='workers', type=int, default=1, help='Downloads per job. Default: 1')
+    parser.add_argument('--max-per-host', type=int, default=MAX_PER_HOST,
+                        help='Simultaneous downloads from one host for all the jobs. Default: {}'.format(MAX_PER_HOST))
+    parser.add_argument('--order', type=str, default='queue', choices=sorted(ORDERINGS))
+    parser.add_argument('--max-rate', type=float, default=None, help='Total download rate of all the jobs, MB/s')
+    parser.add_argument('--max-concurrent', type=float, default=None, help='MB being downloaded at a time')
+    parser.add_argument('--extract-workers', type=int, default=0, help='Extract processes per job')
+    parser.add_argument('--store', metavar='path', type=str, default=None,
+                        help='Products are kept here and linked into the load_path of every job')
+    parser.add_argument('--link', type=str, default='hardlink', choices=('hardlink', 'reflink', 'copy'))
+    parser.add_argument('--min-free', metavar='MB', type=float, default=None,
+                        help='Disk space left by every download, cropped products are evicted to keep it')
+    parser.add_argument('--max-disk-wait', metavar='s', type=float, default=3600)
+    parser.add_argument('--shared-queue', action='store_true',
+                        help='Other processes or hosts load from the same database')
+    parser.add_argument('--metrics-json', metavar='path', type=str, default=None)
+    parser.add_argument('--metrics-prom', metavar='path', type=str, default=None)
+    return parser
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    args = get_parser().parse_args()
+    db = LoaderDB(args.database, wal=not args.no_wal) if args.database else LoaderDB(':memory:')
+    campaign = Campaign(read_jobs(args.jobs), tuple(args.a), db,
+                        workers=args.w,
+                        job_workers=args.job_workers,
+                        max_per_host=args.max_per_host,
+                        scheduler=DownloadScheduler(policy=args.order,
+                                                    bytes_per_second=args.max_rate and args.max_rate / B2MB,
+                                                    max_concurrent_bytes=args.max_concurrent and
+                                                    args.max_concurrent / B2MB),
+                        metrics=RunMetrics(json_path=args.metrics_json, prometheus_path=args.metrics_prom),
+                        tmp_path=args.t,
+                        shared_queue=args.shared_queue,
+                        store=ProductStore(args.store, db, link=args.link) if args.store else None,
+                        disk_budget=DiskBudget(min_free=args.min_free / B2MB, max_wait=args.max_disk_wait)
+                        if args.min_free is not None else None,
+                        extract_workers=args.extract_workers)
+    results = campaign.run()
+    failed = [n for n, result in enumerate(results) if result is None]
+    if failed:
+        logger.error('Jobs {} failed'.format(failed))
+        sys.exit(1)
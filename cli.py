@@ -0,0 +1,99 @@
+"""
+Console entry point of Loader:
+
+    python cli.py -s Sentinel-2 -a user password -p "Majadas EC" -d 2018-04-01 2018-04-30 --database -w 2
+    python cli.py --query -d 2018-04-01 2018-04-02
+
+Loader itself can be imported as a library: nothing is parsed, configured or created on import
+"""
+import sys
+
+from cli_parser import get_parser
+
+import logging
+logger = logging.getLogger()
+
+
+B2MB = 1e-6
+GUEST_AUTH = ('s3guest', 's3guest')
+
+
+def _first(value):
+    """ arguments with nargs=1 are lists unless they have the default value """
+    return value[0] if isinstance(value, list) else value
+
+
+def main(argv=None):
+    """ returns the exit code: 0 if all the products are on disk """
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    platform = _first(args.s)
+    auth = tuple(args.a)
+    if platform in ('Sentinel-1', 'Sentinel-2', 'Sentinel-3') and auth == GUEST_AUTH:
+        parser.error("Sentinel-1,2,3 requires -a [credentials for sci.hub]")
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    logger.info(args)
+
+    # heavy modules are imported only after the arguments are valid
+    from disk import DiskBudget
+    from filters import default_filters
+    from Loader import Loader
+    from LoaderDB import LoaderDB
+    from metrics import RunMetrics
+    from scheduler import DownloadScheduler
+    from store import ProductStore
+    from url_config import urls
+
+    db = LoaderDB('loader.db', wal=not args.no_wal) if args.database else LoaderDB(':memory:')
+    overrides = {
+        'clouds': args.clouds and tuple(args.clouds),
+        'tiles': args.tiles,
+        'exclude_tiles': args.exclude_tiles,
+        'orbits': args.orbits,
+        'exclude_orbits': args.exclude_orbits,
+        'min_size': args.min_size and args.min_size / B2MB,
+        'max_size': args.max_size and args.max_size / B2MB,
+        'hours': args.hours and tuple(args.hours),
+        'newest_baseline': args.newest_baseline,
+    }
+    filters = default_filters(urls[platform]['platformname'],
+                              **{name: value for name, value in overrides.items() if value is not None})
+    loader = Loader(platform_name=platform,
+                    load_path=_first(args.o),
+                    cropped_path=_first(args.c),
+                    auth=auth,
+                    loader_db=db,
+                    product_type_or_level=None,
+                    tmp_path=_first(args.t),
+                    workers=args.w,
+                    max_per_host=args.max_per_host,
+                    chunk_size=args.chunk_size,
+                    cache_ttl=args.cache_ttl * 24 * 3600,
+                    shared_queue=args.shared_queue,
+                    extract_workers=args.extract_workers,
+                    max_pending_extracts=args.max_pending_extracts,
+                    members=args.members,
+                    remote_members=args.remote_members,
+                    filters=filters,
+                    store=ProductStore(args.store, db, link=args.link) if args.store else None,
+                    disk_budget=DiskBudget(min_free=args.min_free / B2MB, max_wait=args.max_disk_wait)
+                    if args.min_free is not None else None,
+                    metrics=RunMetrics(json_path=args.metrics_json, prometheus_path=args.metrics_prom,
+                                       loader_db=db if args.metrics_db else None),
+                    scheduler=DownloadScheduler(policy=args.order,
+                                                bytes_per_second=args.max_rate and args.max_rate / B2MB,
+                                                max_concurrent_bytes=args.max_concurrent and
+                                                args.max_concurrent / B2MB))
+
+    polygon = _first(args.p)
+    period = tuple(args.d.split()) if isinstance(args.d, str) else tuple(args.d)
+    if args.query:
+        for product in loader.query_copernicus(polygon, period):
+            print(product.uuid, product.name, product.date, product.size, product.clouds)
+        return 0
+    results = loader.download(polygon, period)
+    return 0 if all(loaded for _, loaded in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
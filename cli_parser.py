@@ -30,13 +30,97 @@ def get_parser():
                         default="POLYGON ((3.0 54.0, 7.0 54.0, 7.0 50.0, 3.0 50.0, 3.0 54.0))",
                         help='polygon in wkt format or the name of polygon from the database if it was created')
 
-    parser.add_argument('-a',  metavar='credentials', type=tuple, nargs=1,
+    parser.add_argument('-a',  metavar=('user', 'password'), type=str, nargs=2,
                         default=('s3guest', 's3guest'),
                         help='auth for copernicus sci.hub (REQUIRED for Sentinel-1, 2)')
 
+    parser.add_argument('-w',  metavar='workers', type=int,
+                        default=1,
+                        help='Number of products downloaded in parallel. Default: 1')
+
+    parser.add_argument('--max-per-host',  metavar='n', type=int,
+                        default=2,
+                        help='Max number of simultaneous downloads from one host (hub account limit). Default: 2')
+
+    parser.add_argument('--chunk-size',  metavar='bytes', type=int,
+                        default=1024 * 1024,
+                        help='Size of the chunks streamed to the tmp file and hashed. Default: 1 MiB')
+
+    parser.add_argument('--order', type=str,
+                        default='queue',
+                        choices=['queue', 'smallest', 'newest', 'date'],
+                        help='Order of downloads: as found, smallest first, newest first or by date. Default: queue')
+
+    parser.add_argument('--max-rate',  metavar='MB/s', type=float,
+                        default=None,
+                        help='Limit of the download speed of all the workers together')
+
+    parser.add_argument('--max-concurrent',  metavar='MB', type=float,
+                        default=None,
+                        help='Max sum of sizes of products downloaded at the same time')
+
+    parser.add_argument('--cache-ttl',  metavar='days', type=float,
+                        default=30,
+                        help='Periods searched during the last `days` are taken from the database, '
+                             'only the new days go to the hub. 0 disables the cache. Default: 30')
+
     parser.add_argument('--query', action='store_true',
                         help='Flag to do ONLY the query without downloading data')
 
     parser.add_argument('--database', action='store_true',
                         help='Flag to write and use database file (loader.db) instead of in-memory database')
+
+    parser.add_argument('--shared-queue', action='store_true',
+                        help='Other processes or hosts load from the same database: products are claimed '
+                             'under a lease instead of resetting unfinished ones')
+    parser.add_argument('--extract-workers', type=int, default=0,
+                        help='Processes extracting zips while the next products are downloaded. Default: 0 - '
+                             'every worker extracts its product before loading the next one')
+    parser.add_argument('--members', type=str, nargs='+', default=None,
+                        help='Glob patterns of files to extract from the zips, f.e. "Oa0[6-8]_radiance.nc". '
+                             'Default: url_config.member_filters for the platform and type, otherwise everything')
+    parser.add_argument('--remote-members', action='store_true',
+                        help='Fetch only --members from the hub with HTTP Range requests instead of the whole zip')
+    parser.add_argument('--max-pending-extracts', type=int, default=None,
+                        help='Downloads wait while so many products are not extracted yet. '
+                             'Default: 2 per extract worker')
+    parser.add_argument('--store', metavar='path', type=str, default=None,
+                        help='Keep products in this store and link them into the output folders: a product '
+                             'is downloaded once for all the folders. Use with --database')
+    parser.add_argument('--link', type=str, default='hardlink', choices=('hardlink', 'reflink', 'copy'),
+                        help='How products get from the store to the output folder, the next ones are tried '
+                             'if the file system does not support it. Default: hardlink')
+    parser.add_argument('--min-free', metavar='MB', type=float, default=None,
+                        help='Start a download only if its zip and extracted product fit on the disk with so '
+                             'much space left. Cropped products of the output folder are removed (oldest used '
+                             'first) and old tmp files are cleaned to make space')
+    parser.add_argument('--max-disk-wait', metavar='s', type=float, default=3600,
+                        help='A download waits so long for disk space before it fails. Default: 3600')
+
+    parser.add_argument('--clouds', metavar=('min', 'max'), type=float, nargs=2, default=None,
+                        help='Cloud cover range, %%. Default: 0 90 for Sentinel-2, any for other platforms')
+    parser.add_argument('--tiles', type=str, nargs='+', default=None, help='Load only these tiles, f.e. 31UFU')
+    parser.add_argument('--exclude-tiles', type=str, nargs='+', default=None,
+                        help='Do not load these tiles. Default: filters.EXCLUDE_TILES')
+    parser.add_argument('--orbits', type=int, nargs='+', default=None, help='Load only these relative orbits')
+    parser.add_argument('--exclude-orbits', type=int, nargs='+', default=None,
+                        help='Do not load these relative orbits')
+    parser.add_argument('--min-size', type=float, default=None, help='Skip products smaller than this, MB')
+    parser.add_argument('--max-size', type=float, default=None, help='Skip products bigger than this, MB')
+    parser.add_argument('--hours', metavar=('start', 'end'), type=float, nargs=2, default=None,
+                        help='Sensing start between these UTC hours, f.e. 9 13 or 22 2')
+    parser.add_argument('--newest-baseline', action='store_true',
+                        help='Load only the latest processing baseline of every acquisition')
+
+    parser.add_argument('--no-wal', action='store_true',
+                        help='Do not use WAL journal, required if the database is on a network volume')
+
+    parser.add_argument('--metrics-json', metavar='path', type=str, default=None,
+                        help='Write per-stage timings of the run as json')
+
+    parser.add_argument('--metrics-prom', metavar='path', type=str, default=None,
+                        help='Write per-stage timings as Prometheus textfile (for node_exporter)')
+
+    parser.add_argument('--metrics-db', action='store_true',
+                        help='Store per-product timings in the metrics table of the database')
     return parser
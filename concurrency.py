@@ -0,0 +1,100 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import logging
+logger = logging.getLogger()
+
+
+MAX_PER_HOST = 2  # dhus allows 2 simultaneous downloads per account
+
+
+class HostLimiter:
+    """
+    Caps the number of simultaneous transfers to one host, shared by all workers of a Loader
+    """
+    def __init__(self, max_per_host=MAX_PER_HOST):
+        self.max_per_host = max_per_host
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def _semaphore(self, host):
+        with self._lock:
+            if host not in self._slots:
+                self._slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._slots[host]
+
+    @contextmanager
+    def slot(self, url):
+        host = urlparse(url).netloc
+        semaphore = self._semaphore(host)
+        semaphore.acquire()
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+
+def map_ordered(func, items, workers=1):
+    """
+    Applies `func` to every item with `workers` threads, results are returned in the order of `items`
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(func, items))
+
+
+class Heartbeat:
+    """
+    Calls `func` every `interval` seconds in a background thread while the `with` block runs
+    """
+    def __init__(self, func, interval):
+        self.func = func
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.func()
+            except Exception:
+                logger.exception('Heartbeat failed')
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+class OncePerKey:
+    """
+    func runs once per key: concurrent and later callers with the same key get the result (or the exception)
+    of the first call. Shared by the Loaders of a campaign, so a product is loaded once by uuid
+    """
+    def __init__(self):
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, func):
+        """ returns (result, True if this call ran func) """
+        with self._lock:
+            future = self._futures.get(key)
+            first = future is None
+            if first:
+                future = self._futures[key] = Future()
+        if not first:
+            return future.result(), False
+        try:
+            result = func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        future.set_result(result)
+        return result, True
@@ -0,0 +1,232 @@
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import Future
+
+from pipeline import PART_SUFFIX
+
+import logging
+logger = logging.getLogger()
+
+
+MIN_FREE = 1024 ** 3  # bytes left free on every volume
+MAX_WAIT = 3600  # s a download waits for space before it fails
+ADMIT_POLL = 5  # s between checks of the free space while waiting
+ORPHAN_AGE = 24 * 3600  # s, tmp and .part files not changed for so long are left by crashed runs
+EXTRACT_FACTOR = 1.0  # an extracted product takes about the size of its zip (NetCDF and JP2 hardly compress)
+B2MB = 1e-6
+
+
+class DiskBudgetError(Exception):
+    pass
+
+
+def _existing(path):
+    """ `path` or its nearest existing parent: folders which will be created are on its volume """
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def volume(path):
+    return os.stat(_existing(path)).st_dev
+
+
+def free_bytes(path):
+    return shutil.disk_usage(_existing(path)).free
+
+
+def last_used(path):
+    """ the latest access or modification time of a file or of the files in a folder """
+    stat = os.stat(path)
+    used = max(stat.st_atime, stat.st_mtime)
+    if os.path.isdir(path):
+        for folder, _, files in os.walk(path):
+            for name in files:
+                stat = os.stat(os.path.join(folder, name))
+                used = max(used, stat.st_atime, stat.st_mtime)
+    return used
+
+
+def freeable(path):
+    """ bytes freed by removing a file or a folder: files linked elsewhere (f.e. in a store) free nothing """
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return stat.st_size if stat.st_nlink == 1 else 0
+    freed = 0
+    for folder, _, files in os.walk(path):
+        for name in files:
+            stat = os.stat(os.path.join(folder, name))
+            if stat.st_nlink == 1:
+                freed += stat.st_size
+    return freed
+
+
+def remove(path):
+    """ removes a file or a folder, returns bytes freed """
+    freed = freeable(path)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+    return freed
+
+
+class DiskBudget:
+    """
+    Admission control of downloads: reserve() returns when the zip (in the tmp folder) and the extracted product
+    (in load_path or the store) fit on their volumes with `min_free` bytes left, counting the space reserved
+    by the downloads which are running. Sizes are the ones reported by the hub.
+    If there is no space, orphaned tmp files are removed and then, once per reserve() and only if it's enough
+    together with the space the running downloads release, the least recently used products of the
+    watched load paths which are already cropped; otherwise reserve() waits up to `max_wait` s for running
+    downloads to finish and raises DiskBudgetError.
+    One budget is shared by all the Loaders of a process; other processes are seen only by the free space
+    """
+    def __init__(self, min_free=MIN_FREE, max_wait=MAX_WAIT, orphan_age=ORPHAN_AGE, extract_factor=EXTRACT_FACTOR):
+        self.min_free = min_free
+        self.max_wait = max_wait
+        self.orphan_age = orphan_age
+        self.extract_factor = extract_factor
+        self._areas = {}  # load_path: presence.PresenceIndex
+        self._tmp = set()  # (tmp_path, prefix of tmp files)
+        self._reservations = {}  # key: [(volume, path, bytes)]
+        self._cond = threading.Condition()
+        self.evicted_bytes = 0
+
+    def watch(self, load_path, presence, tmp_path, tmp_prefix):
+        """ products of `load_path` may be evicted once `presence` finds them cropped, tmp files are cleaned """
+        with self._cond:
+            self._areas[load_path] = presence
+            self._tmp.add((tmp_path, tmp_prefix))
+
+    def needs(self, size, tmp_file, unzip_path):
+        """ {path: bytes} for reserve(): the zip and the extracted product """
+        size = size or 0
+        return {tmp_file: size, unzip_path: int(size * self.extract_factor)}
+
+    def reserve(self, key, needs):
+        """ `needs` {file or folder: bytes to be written there}, the reservation is kept until release(key) """
+        deadline = time.time() + self.max_wait
+        evicted = False
+        with self._cond:
+            while True:
+                short = self._shortage(needs)
+                if not short:
+                    break
+                if not evicted:  # once: products evicted for nothing are lost, waiting frees the rest
+                    evicted = True
+                    self._evict(short)
+                    short = self._shortage(needs)
+                    if not short:
+                        break
+                if not self._reservations or time.time() >= deadline:  # nothing will be released in time
+                    raise DiskBudgetError('{:.1f} MB more are needed for {}'.format(
+                        max(short.values()) * B2MB, key))
+                logger.warning('Waiting for {:.1f} MB of disk space for {}'.format(max(short.values()) * B2MB, key))
+                self._cond.wait(min(ADMIT_POLL, deadline - time.time()))
+            self._reservations[key] = [(volume(path), path, n_bytes) for path, n_bytes in needs.items()]
+
+    def release(self, key):
+        with self._cond:
+            self._reservations.pop(key, None)
+            self._cond.notify_all()
+
+    def release_when_done(self, key, job):
+        """ `job` is the result of Loader.load_if_not_yet: released at once or when the Future is done """
+        if isinstance(job, Future):
+            job.add_done_callback(lambda _: self.release(key))
+        else:
+            self.release(key)
+        return job
+
+    def _unwritten(self):
+        """ {volume: bytes} reserved by the running downloads and not written yet """
+        unwritten = {}
+        for reserved in self._reservations.values():
+            for device, path, n_bytes in reserved:  # a growing tmp file takes its space already
+                written = os.path.getsize(path) if os.path.isfile(path) else 0
+                unwritten[device] = unwritten.get(device, 0) + max(n_bytes - written, 0)
+        return unwritten
+
+    def _shortage(self, needs):
+        """ {volume: bytes missing} for `needs` """
+        wanted = {}
+        for path, n_bytes in needs.items():
+            device = volume(path)
+            if device not in wanted:
+                wanted[device] = [path, self.min_free]
+            wanted[device][1] += n_bytes
+        for device, n_bytes in self._unwritten().items():
+            if device in wanted:
+                wanted[device][1] += n_bytes
+        short = {}
+        for device, (path, n_bytes) in wanted.items():
+            free = free_bytes(path)
+            if n_bytes > free:
+                short[device] = n_bytes - free
+        return short
+
+    def _reserved_paths(self):
+        with self._cond:  # reserve() and release() of other threads change the dict
+            return {os.path.abspath(path) for reserved in self._reservations.values() for _, path, _ in reserved}
+
+    def clean_orphans(self):
+        """ removes tmp files and .part entries not changed for `orphan_age` s, returns bytes freed """
+        with self._cond:
+            reserved = self._reserved_paths()
+            tmp_paths = list(self._tmp)
+            load_paths = list(self._areas)
+        old = time.time() - self.orphan_age
+        candidates = []
+        for tmp_path, prefix in tmp_paths:
+            if os.path.isdir(tmp_path):
+                candidates.extend(os.path.join(tmp_path, entry) for entry in os.listdir(tmp_path)
+                                  if entry.startswith(prefix))
+        for load_path in load_paths:
+            if os.path.isdir(load_path):
+                candidates.extend(os.path.join(load_path, entry) for entry in os.listdir(load_path)
+                                  if entry.endswith(PART_SUFFIX))
+        freed = 0
+        for path in candidates:
+            if os.path.abspath(path) in reserved or os.path.abspath(path).split(PART_SUFFIX)[0] in reserved:
+                continue
+            try:
+                if os.stat(path).st_mtime < old:
+                    freed += remove(path)
+                    logger.info('Removed orphaned {}'.format(path))
+            except OSError as e:  # removed by another process
+                logger.debug('{} was not removed: {}'.format(path, e))
+        return freed
+
+    def _evict(self, short):
+        """ frees `short` {volume: bytes}: orphans first, then the least recently used cropped products """
+        orphans = self.clean_orphans()
+        if orphans:
+            logger.info('{:.1f} MB of orphaned tmp files were removed'.format(orphans * B2MB))
+        candidates = []
+        for load_path, presence in self._areas.items():
+            if not os.path.isdir(load_path) or volume(load_path) not in short:
+                continue
+            for entry in os.listdir(load_path):
+                path = os.path.join(load_path, entry)
+                if entry.endswith(PART_SUFFIX) or not presence.has_cropped(entry.split('.', 1)[0]):
+                    continue
+                n_bytes = freeable(path)
+                if n_bytes:  # links to a store free nothing
+                    candidates.append((last_used(path), path, volume(path), n_bytes))
+        freed = dict.fromkeys(short, 0)
+        unwritten = self._unwritten()
+        for device in short:  # evict only if it's enough, together with the space the running downloads release
+            evictable = sum(n_bytes for _, _, on, n_bytes in candidates if on == device)
+            if evictable + unwritten.get(device, 0) < short[device] - orphans:
+                freed[device] = short[device]
+        for _, path, device, _ in sorted(candidates):
+            if freed[device] >= short[device]:
+                continue
+            n_bytes = remove(path)
+            freed[device] += n_bytes
+            self.evicted_bytes += n_bytes
+            logger.info('Evicted {} ({:.1f} MB), it is cropped already'.format(path, n_bytes * B2MB))
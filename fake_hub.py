@@ -0,0 +1,209 @@
+import hashlib
+import io
+import random
+import re
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import logging
+logger = logging.getLogger()
+
+
+PAGE_TEMPLATE = """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/" xmlns="http://www.w3.org/2005/Atom">
+<title>Sentinels Scientific Data Hub search results</title>
+<subtitle>Displaying {first} to {last} of {total} total results. Request done in 0.001 seconds.</subtitle>
+<opensearch:totalResults>{total}</opensearch:totalResults>
+<opensearch:startIndex>{start}</opensearch:startIndex>
+<opensearch:itemsPerPage>{rows}</opensearch:itemsPerPage>
+{entries}
+</feed>"""
+
+ENTRY_TEMPLATE = """<entry>
+<title>{name}</title>
+<id>{uuid}</id>
+<date name="ingestiondate">{ingestion}</date>
+<date name="beginposition">{begin}</date>
+<date name="endposition">{begin}</date>
+<double name="cloudcoverpercentage">{clouds}</double>
+<str name="footprint">{footprint}</str>
+<str name="size">{size:.2f} MB</str>
+<str name="identifier">{name}</str>
+<str name="uuid">{uuid}</str>
+</entry>"""
+
+RE_PRODUCT = r"/odata/v1/Products\('([^']+)'\)/(\$value|Checksum/Value/\$value)"
+RE_RANGE = r'bytes=(\d+)-(\d*)'
+FIRST_DATE = datetime(2018, 4, 1, 10, 0, 0)
+N_MEMBERS = 4
+CACHED_PRODUCTS = 16
+FOOTPRINT = 'POLYGON ((3.0 54.0, 7.0 54.0, 7.0 50.0, 3.0 50.0, 3.0 54.0))'
+
+
+def make_product_zip(name, payload, n_members=N_MEMBERS):
+    """
+    stored (not compressed) zip: name.SEN3/ with `n_members` .nc files of `payload`.
+    Members have a fixed date, so the zip (and its md5) is the same whenever it is built
+    """
+    buffer = io.BytesIO()
+    date_time = FIRST_DATE.timetuple()[:6]
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as z:
+        z.writestr(zipfile.ZipInfo(name + '.SEN3/', date_time), b'')
+        for i in range(n_members):
+            z.writestr(zipfile.ZipInfo('{}.SEN3/band_{:02d}.nc'.format(name, i), date_time), payload)
+    return buffer.getvalue()
+
+
+class FakeHub:
+    """
+    Local stand-in for the OpenSearch and OData endpoints of url_config.urls:
+    `n_products` synthetic products of `product_size` bytes, every request waits `latency` s,
+    fails with 503 with probability `error_rate` and every connection is limited to `bandwidth` bytes/s.
+    All products share the same random payload, only zips of the last CACHED_PRODUCTS products are kept
+    """
+    def __init__(self, n_products=250, product_size=10 * 1024 * 1024, latency=0.0, error_rate=0.0,
+                 bandwidth=None, port=0, seed=0):
+        self.n_products = n_products
+        self.latency = latency
+        self.error_rate = error_rate
+        self.bandwidth = bandwidth
+        self.random = random.Random(seed)
+        self.payload = self.random.randbytes(max(product_size // N_MEMBERS, 1))
+        self.product_size = len(make_product_zip(self.name(0), self.payload))
+        self._products = OrderedDict()
+        self.requests = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/dhus'.format(self.server.server_port)
+
+    def urls(self):
+        """ to update Loader.url_dict """
+        return {
+            'url_search': self.url + '/search?q=',
+            'url_download': self.url + "/odata/v1/Products('{}')/$value",
+            'url_md5': self.url + "/odata/v1/Products('{}')/Checksum/Value/$value",
+        }
+
+    def name(self, i):
+        date = FIRST_DATE + timedelta(hours=i)
+        return 'S3A_OL_1_EFR____{:%Y%m%dT%H%M%S}_{:%Y%m%dT%H%M%S}_FAKE_{:06d}'.format(date, date, i)
+
+    def product(self, uuid):
+        """ (zip content, md5) """
+        with self._lock:
+            if uuid in self._products:
+                self._products.move_to_end(uuid)
+                return self._products[uuid]
+        content = make_product_zip(self.name(int(uuid.rsplit('-', 1)[-1])), self.payload)
+        product = content, hashlib.md5(content).hexdigest().upper()  # the hub gives upper case
+        with self._lock:
+            self._products[uuid] = product
+            if len(self._products) > CACHED_PRODUCTS:
+                self._products.popitem(last=False)
+        return product
+
+    def page(self, start, rows):
+        entries = []
+        for i in range(start, min(start + rows, self.n_products)):
+            begin = FIRST_DATE + timedelta(hours=i)
+            entries.append(ENTRY_TEMPLATE.format(name=self.name(i), uuid='fake-{:06d}'.format(i),
+                                                 begin=begin.isoformat(timespec='milliseconds') + 'Z',
+                                                 ingestion=(begin + timedelta(hours=3)).isoformat() + 'Z',
+                                                 clouds=i % 100 + 0.5, footprint=FOOTPRINT,
+                                                 size=self.product_size / 1024 ** 2))
+        return PAGE_TEMPLATE.format(first=start + 1, last=start + len(entries), total=self.n_products,
+                                    start=start, rows=rows, entries='\n'.join(entries)).encode('utf-8')
+
+    def _handler(self):
+        hub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with hub._lock:
+                    hub.requests += 1
+                    fail = hub.random.random() < hub.error_rate
+                if hub.latency:
+                    time.sleep(hub.latency)
+                if fail:
+                    self.send_response(503)
+                    self.send_header('Retry-After', '0')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                url = urlparse(self.path)
+                if url.path.endswith('/search'):
+                    query = parse_qs(url.query)
+                    return self._send(hub.page(int(query.get('start', ['0'])[0]),
+                                               int(query.get('rows', ['100'])[0])))
+                match = re.search(RE_PRODUCT, url.path)
+                if match is None:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                content, md5 = hub.product(match.group(1))
+                if match.group(2) == '$value':
+                    return self._send(content, self.headers.get('Range'))
+                return self._send(md5.encode('utf-8'))
+
+            def _send(self, body, range_header=None):
+                start, end = 0, len(body) - 1
+                match = re.match(RE_RANGE, range_header or '')
+                if match:
+                    start = int(match.group(1))
+                    end = min(int(match.group(2)), end) if match.group(2) else end
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(body)))
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Length', str(end - start + 1))
+                self.send_header('ETag', '"fake"')
+                self.send_header('Accept-Ranges', 'bytes')
+                self.end_headers()
+                view = memoryview(body)[start:end + 1]
+                with hub._lock:
+                    hub.bytes_sent += len(view)
+                step = 64 * 1024
+                started = time.monotonic()
+                try:
+                    for offset in range(0, len(view), step):
+                        self.wfile.write(view[offset:offset + step])
+                        if hub.bandwidth:
+                            ahead = (offset + step) / hub.bandwidth - (time.monotonic() - started)
+                            if ahead > 0:
+                                time.sleep(ahead)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
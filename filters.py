@@ -0,0 +1,126 @@
+import re
+from collections import Counter
+
+import logging
+logger = logging.getLogger()
+
+
+# S2A_MSIL1C_20180401T105031_N0206_R051_T31UFU_20180401T144530
+RE_S2_NAME = r'^(S2[AB])_(MSI\w{3})_(\d{8}T\d{6})_N(\d{4})_R(\d{3})_T(\w{5})_(\d{8}T\d{6})'
+# S3A_OL_1_EFR____20180401T095834_20180401T100134_20180402T140107_0179_029_236_2160_LN1_O_NT_002
+RE_S3_NAME = r'^(S3[AB])_(\w{2}_\d_\w{6})_(\d{8}T\d{6})_(\d{8}T\d{6})_(\d{8}T\d{6})_\w{4}_(\d{3})_(\d{3})_(\w{4})_' \
+             r'\w{3}_\w_(\w{2})_(\w{3})'
+TIMELINESS = {'NR': 0, 'ST': 1, 'NT': 2}  # S3 near real time products are reprocessed as non time critical
+CLOUD_PLATFORMS = ('Sentinel-2', )  # cloudcoverpercentage is given for every product of these platforms
+MAX_CLOUD_COVER = 90
+EXCLUDE_TILES = ('29TQE', )  # temporal measure for S2 as I don't know TQE TTK difference
+
+
+def parse_name(name):
+    """
+    Fields of S2 and S3 product names: tile, orbit (relative), sensing time, acquisition (the same for all the
+    processings of one acquisition) and version (the newer processing is the bigger one). {} for other names
+    """
+    match = re.match(RE_S2_NAME, name)
+    if match:
+        mission, level, sensing, baseline, orbit, tile, processed = match.groups()
+        return {'tile': tile, 'orbit': int(orbit), 'sensing': sensing,
+                'acquisition': (mission, level, sensing, orbit, tile), 'version': (baseline, processed)}
+    match = re.match(RE_S3_NAME, name)
+    if match:
+        mission, product_type, start, stop, created, _, orbit, frame, timeliness, baseline = match.groups()
+        return {'tile': None, 'orbit': int(orbit), 'sensing': start,
+                'acquisition': (mission, product_type, start, orbit, frame),
+                'version': (TIMELINESS.get(timeliness, -1), baseline, created)}
+    return {}
+
+
+class FilterSpec:
+    """
+    What is not loaded: cloud cover out of `clouds` (min, max) %, tiles / relative orbits not in `tiles` /
+    `orbits` or in `exclude_tiles` / `exclude_orbits`, size (bytes) out of `min_size` / `max_size`, sensing start
+    out of `hours` (start, end) UTC - may go over midnight, f.e. (22, 2). `newest_baseline` keeps only the latest
+    processing of every acquisition.
+    What OpenSearch can do goes to the query (see query_clause), everything is checked again by apply()
+    because the query cache keeps products of other queries too. Products without a field pass its filter
+    """
+    def __init__(self, clouds=None, tiles=None, exclude_tiles=None, orbits=None, exclude_orbits=None,
+                 min_size=None, max_size=None, hours=None, newest_baseline=False):
+        self.clouds = clouds
+        self.tiles = {tile.lstrip('T') for tile in tiles} if tiles else None
+        self.exclude_tiles = {tile.lstrip('T') for tile in exclude_tiles or ()}
+        self.orbits = set(orbits) if orbits else None
+        self.exclude_orbits = set(exclude_orbits or ())
+        self.min_size = min_size
+        self.max_size = max_size
+        self.hours = hours
+        self.newest_baseline = newest_baseline
+
+    def query_clause(self, platformname):
+        """ part of the OpenSearch query, '' if nothing can be searched by the hub """
+        clauses = []
+        if self.clouds is not None and platformname in CLOUD_PLATFORMS:
+            clauses.append('cloudcoverpercentage:[{} TO {}]'.format(*self.clouds))
+        if self.orbits:
+            clauses.append('relativeorbitnumber:({})'.format(' OR '.join(str(o) for o in sorted(self.orbits))))
+        return ' AND '.join(clauses)
+
+    def reject_reason(self, product):
+        """ None if `product` (opensearch.Product) passes the filters (except newest_baseline) """
+        fields = parse_name(product.name)
+        if self.clouds is not None and product.clouds is not None \
+                and not self.clouds[0] <= product.clouds <= self.clouds[1]:
+            return 'clouds'
+        tile = fields.get('tile')
+        if tile is not None and ((self.tiles is not None and tile not in self.tiles) or tile in self.exclude_tiles):
+            return 'tile'
+        orbit = fields.get('orbit')
+        if orbit is not None and ((self.orbits is not None and orbit not in self.orbits)
+                                  or orbit in self.exclude_orbits):
+            return 'orbit'
+        if product.size is not None and ((self.min_size is not None and product.size < self.min_size)
+                                         or (self.max_size is not None and product.size > self.max_size)):
+            return 'size'
+        if self.hours is not None and product.date is not None:
+            hour = product.date.hour + product.date.minute / 60
+            start, end = self.hours
+            if not (start <= hour < end if start <= end else hour >= start or hour < end):
+                return 'time of day'
+
+    def apply(self, products):
+        """ products to load, in the same order """
+        rejected = Counter()
+        kept = []
+        for product in products:
+            reason = self.reject_reason(product)
+            if reason is None:
+                kept.append(product)
+            else:
+                rejected[reason] += 1
+                logger.debug('{} is skipped: {}'.format(product.name, reason))
+        if self.newest_baseline:
+            before = len(kept)
+            kept = newest_baselines(kept)
+            rejected['older baseline'] = before - len(kept)
+        if sum(rejected.values()):
+            logger.info('{} of {} products are skipped: {}'.format(sum(rejected.values()), len(products),
+                                                                   dict(+rejected)))
+        return kept
+
+
+def newest_baselines(products):
+    """ only the latest processing of every acquisition, products with unknown names are kept """
+    newest = {}
+    for product in products:
+        fields = parse_name(product.name)
+        if fields and fields['version'] > newest.get(fields['acquisition'], ((), None))[0]:
+            newest[fields['acquisition']] = fields['version'], product.uuid
+    latest = {uuid for _, uuid in newest.values()}
+    return [p for p in products if p.uuid in latest or not parse_name(p.name)]
+
+
+def default_filters(platformname, **kwargs):
+    """ what Loader always skipped: overcast S2 images and EXCLUDE_TILES, `kwargs` of FilterSpec override it """
+    kwargs.setdefault('clouds', (0, MAX_CLOUD_COVER) if platformname in CLOUD_PLATFORMS else None)
+    kwargs.setdefault('exclude_tiles', EXCLUDE_TILES)
+    return FilterSpec(**kwargs)
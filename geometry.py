@@ -0,0 +1,126 @@
+import re
+
+import logging
+logger = logging.getLogger()
+
+
+RE_RING = r'\(([^()]+)\)'
+RE_POLYGON = r'\(\s*(\([^()]+\)(?:\s*,\s*\([^()]+\))*)\s*\)'
+EPSILON = 1e-12
+
+
+def parse_wkt(wkt):
+    """
+    POLYGON or MULTIPOLYGON wkt -> [polygon], polygon is [ring], ring is [(x, y)], the first ring is the outer one.
+    Returns None for other geometries
+    """
+    kind = wkt.strip().split('(', 1)[0].strip().upper()
+    if kind not in ('POLYGON', 'MULTIPOLYGON'):
+        logger.warning('Unsupported geometry {}'.format(wkt[:40]))
+        return None
+    body = wkt[wkt.index('('):]
+    if kind == 'POLYGON':
+        bodies = [body]
+    else:
+        bodies = [match.group(0) for match in re.finditer(RE_POLYGON, body[1:-1])]
+    polygons = []
+    for polygon_body in bodies:
+        rings = []
+        for ring in re.findall(RE_RING, polygon_body):
+            rings.append([tuple(float(v) for v in point.split()[:2]) for point in ring.split(',')])
+        polygons.append(rings)
+    return polygons
+
+
+def bbox(polygons):
+    """ (min_x, max_x, min_y, max_y) """
+    xs = [x for polygon in polygons for x, _ in polygon[0]]
+    ys = [y for polygon in polygons for _, y in polygon[0]]
+    return min(xs), max(xs), min(ys), max(ys)
+
+
+def _edges(ring):
+    return zip(ring, ring[1:] + ring[:1])
+
+
+def _cross(o, a, b):
+    return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+
+def _on_segment(p, a, b):
+    return (abs(_cross(a, b, p)) <= EPSILON and min(a[0], b[0]) - EPSILON <= p[0] <= max(a[0], b[0]) + EPSILON
+            and min(a[1], b[1]) - EPSILON <= p[1] <= max(a[1], b[1]) + EPSILON)
+
+
+def _in_ring(point, ring):
+    """ 1 inside, 0 on the boundary, -1 outside (ray casting) """
+    x, y = point
+    inside = False
+    for a, b in _edges(ring):
+        if _on_segment(point, a, b):
+            return 0
+        if (a[1] > y) != (b[1] > y) and x < (b[0] - a[0]) * (y - a[1]) / (b[1] - a[1]) + a[0]:
+            inside = not inside
+    return 1 if inside else -1
+
+
+def point_in_polygon(point, polygon):
+    """ 1 inside, 0 on the boundary (of the outer ring or a hole), -1 outside """
+    where = _in_ring(point, polygon[0])
+    if where != 1:
+        return where
+    for hole in polygon[1:]:
+        in_hole = _in_ring(point, hole)
+        if in_hole != -1:
+            return -in_hole
+    return 1
+
+
+def _segments_cross(a, b, c, d):
+    """ segments ab and cd cross at a point which is interior to both of them """
+    d1, d2 = _cross(c, d, a), _cross(c, d, b)
+    d3, d4 = _cross(a, b, c), _cross(a, b, d)
+    return ((d1 > EPSILON and d2 < -EPSILON) or (d1 < -EPSILON and d2 > EPSILON)) and \
+        ((d3 > EPSILON and d4 < -EPSILON) or (d3 < -EPSILON and d4 > EPSILON))
+
+
+def _segments_touch(a, b, c, d):
+    return (_segments_cross(a, b, c, d) or _on_segment(a, c, d) or _on_segment(b, c, d)
+            or _on_segment(c, a, b) or _on_segment(d, a, b))
+
+
+def _polygon_contains(outer, inner):
+    # no edge of `inner` crosses the boundary of `outer` and every vertex and edge midpoint is not outside
+    for a, b in _edges(inner[0]):
+        for ring in outer:
+            if any(_segments_cross(a, b, c, d) for c, d in _edges(ring)):
+                return False
+        middle = ((a[0] + b[0]) / 2, (a[1] + b[1]) / 2)
+        if point_in_polygon(a, outer) == -1 or point_in_polygon(middle, outer) == -1:
+            return False
+    # holes of `outer` must be outside of `inner`
+    return all(point_in_polygon(point, inner) != 1 for hole in outer[1:] for point in hole)
+
+
+def _polygons_intersect(first, second):
+    if any(_segments_touch(a, b, c, d) for ring in first for a, b in _edges(ring)
+           for other in second for c, d in _edges(other)):
+        return True
+    # no common boundary points => one is inside the other or they are disjoint
+    return point_in_polygon(first[0][0], second) == 1 or point_in_polygon(second[0][0], first) == 1
+
+
+def _bboxes_intersect(first, second):
+    return first[0] <= second[1] and second[0] <= first[1] and first[2] <= second[3] and second[2] <= first[3]
+
+
+def contains(outer, inner):
+    """ every polygon of `inner` is within some polygon of `outer` (parsed by parse_wkt), touching is allowed """
+    return all(any(_polygon_contains(o, i) for o in outer) for i in inner)
+
+
+def intersects(first, second):
+    """ geometries (parsed by parse_wkt) have at least one common point """
+    if not _bboxes_intersect(bbox(first), bbox(second)):
+        return False
+    return any(_polygons_intersect(f, s) for f in first for s in second)
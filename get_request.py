@@ -1,6 +1,10 @@
 import os
-import requests
 import time
+from collections import namedtuple
+from contextlib import nullcontext
+
+from partial_download import PartialDownload
+from retry import RequestError, UnauthorizedError, DEFAULT_POLICY, DEFAULT_BREAKER, parse_retry_after
 
 import logging
 # # if you want to control logs uncomment all lines
@@ -9,65 +13,167 @@ import logging
 logger = logging.getLogger()
 
 
-TRY_RECONNECT = 3
 REQUEST_TIMEOUT = 5
-SLEEP_NOT_OK = 1800
 DOWNLOAD_TIMEOUT = 900
 SEC_2_MIN = 1 / 60
+CHUNK_SIZE = 1024 * 1024  # 1 MiB
+HASH_NAMES = ('md5', )  # any name from hashlib, f.e. 'sha3_256'
+
+POOL_SIZE = 4
+
+
+def make_session(pool_size=POOL_SIZE, auth=None):
+    """
+    Keep-alive session with a connection pool per host, to be shared by queries, check sums and downloads
+    """
+    import requests  # ~0.1 s, imported on the first use so that `import Loader` stays fast
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.auth = auth
+    return session
+
 
+# what is returned for downloads to a file: nothing is kept in memory except the hex digests
+LoadedFile = namedtuple('LoadedFile', ['path', 'size', 'digests', 'partial'], defaults=(None, ))  # partial: PartialDownload
 
-def get_request(url, auth, tmp_path=None):
+
+def get_request(url, auth, tmp_path=None, chunk_size=CHUNK_SIZE, hash_names=HASH_NAMES, session=None,
+                throttle=None, policy=None, breaker=None, slot=None, metrics=None, headers=None):
+    """
+    If `tmp_path` is None returns the content of the response, otherwise streams the response to `tmp_path`,
+    hashing it on the fly, and returns LoadedFile.
+    Downloads to `tmp_path` are resumed with Range requests (see PartialDownload),
+    attempts that brought new bytes don't count in `policy.attempts`.
+    Connections are reused if `session` (see make_session) is given.
+    `throttle(n_bytes)` is called after every chunk written to `tmp_path` (see scheduler.DownloadScheduler).
+    Failed attempts wait as `policy` (retry.RetryPolicy) says, `breaker` (retry.CircuitBreaker) is shared by all
+    the workers. `slot()` is a context manager held only while connected, not while waiting for the next attempt.
+    `metrics` (metrics.RunMetrics or ProductMetrics) gets ttfb, download, hash, retries and backoff_wait.
+    `headers` are sent with requests for the content (f.e. Range, see remote_zip.RangeFile).
+    Raises UnauthorizedError on 401, returns (None, tried) if all attempts failed
+    """
+    if session is None:
+        import requests as http
+    else:
+        http = session
+    policy = policy or DEFAULT_POLICY
+    breaker = breaker or DEFAULT_BREAKER
     start_f = time.time()
     loaded = None
     tried = 0
-    while tried < TRY_RECONNECT:
+    delay = 0
+    partial = None if tmp_path is None else PartialDownload(tmp_path, url, hash_names)
+    bytes_first = partial.bytes_done if partial else 0  # resumed from the previous run
+    if partial and partial.bytes_done and partial.bytes_done == partial.size:  # kept complete, its sum wasn't loaded
+        partial.finish()
+        return LoadedFile(tmp_path, partial.bytes_done, partial.digests(), partial), 0
+    while tried < policy.attempts:
+        if delay:
+            time.sleep(delay)
+            delay = 0
         tried += 1
+        waited = breaker.wait(url)
+        if metrics is not None and waited:
+            metrics.observe('backoff_wait', waited)
         logger.debug('Connecting... attempt # {}'.format(tried))
         timeout = False
         start = time.time()
+        bytes_before = partial.bytes_done if partial else 0
+        r = None
         try:
-            # if tmp_path is None:  # because query or md5 were asked
-            #     r = requests.get(url, auth=auth, timeout=REQUEST_TIMEOUT)
-            # else:
-            r = requests.get(url, auth=auth, stream=True, timeout=REQUEST_TIMEOUT)
-            if not r.ok:
-                if r.status_code == 401:
-                    logger.critical('401 UNAUTHORIZED. Did you provide valid credentials in -a parameter?')
-                    exit(-1)
-                if r.status_code == 500:
-                    logger.critical('Internal server error. Rethrowing is useless')
-                    return loaded, tried
-                logger.warning('Status code {}. Sleeping for SLEEP_NOT_OK time {}s'.format(r.status_code, SLEEP_NOT_OK))
-                time.sleep(SLEEP_NOT_OK)
-                continue
-            if tmp_path is not None:
-                os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
-                with open(tmp_path, 'wb') as tmp:
-                    for chunk in r.iter_content(chunk_size=1024):
-                        # if chunk:  # filter out keep-alive new chunks
-                        tmp.write(chunk)
-                        if time.time() - start > DOWNLOAD_TIMEOUT:
-                            r.close()
-                            logger.warning('Custom timeout on download {}'.format(tried))
-                            timeout = True
-                            break
+            with slot() if slot is not None else nullcontext():
+                # if tmp_path is None:  # because query or md5 were asked
+                #     r = requests.get(url, auth=auth, timeout=REQUEST_TIMEOUT)
+                # else:
+                r = http.get(url, auth=auth, stream=True, timeout=REQUEST_TIMEOUT,
+                             headers=partial.range_headers() if partial else headers)
+                if metrics is not None:
+                    metrics.observe('ttfb', time.time() - start)
+                if not r.ok:
+                    r.close()  # with a shared session the connection has to go back to the pool
+                    if r.status_code == 401:
+                        logger.critical('401 UNAUTHORIZED. Did you provide valid credentials in -a parameter?')
+                        raise UnauthorizedError('401 UNAUTHORIZED for {}'.format(url))
+                    if r.status_code == 416 and partial:  # Range Not Satisfiable => our part is not valid anymore
+                        logger.warning('Range was not accepted for {}, restarting from zero'.format(tmp_path))
+                        partial.restart()
+                        continue
+                    if not policy.is_retryable(r.status_code):
+                        logger.critical('Status code {} for {}. Rethrowing is useless'.format(r.status_code, url))
+                        return loaded, tried
+                    retry_after = parse_retry_after(r.headers.get('Retry-After'))
+                    breaker.failure(url, retry_after)
+                    if tried < policy.attempts:
+                        delay = policy.delay(tried, retry_after)
+                        logger.warning('Status code {}. Retrying in {:.0f}s'.format(r.status_code, delay))
+                        _count_retry(metrics, delay)
+                    continue
+                breaker.success(url)
+                if tmp_path is not None:
+                    os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
+                    mode = partial.accept(r)
+                    with open(tmp_path, mode) as tmp:
+                        tmp.seek(partial.bytes_done)
+                        tmp.truncate()
+                        try:
+                            for chunk in r.iter_content(chunk_size=chunk_size):
+                                # if chunk:  # filter out keep-alive new chunks
+                                tmp.write(chunk)
+                                partial.update(chunk, tmp)
+                                if throttle is not None:
+                                    throttle(len(chunk))
+                                if time.time() - start > DOWNLOAD_TIMEOUT:
+                                    r.close()
+                                    logger.warning('Custom timeout on download {}'.format(tried))
+                                    timeout = True
+                                    break
+                        finally:
+                            tmp.flush()
+                            partial.save()
+                    r.close()
+                else:
+                    loaded = r.content
+                    r.close()  # returns the connection to the pool
+                    break
+        except RequestError:
+            raise
         except Exception as e:  # may be (requests.exceptions.Timeout, requests.exceptions.ConnectionError)
             passed = time.time() - start
             logger.warning('Exception: {}; {} seconds passed, retrying...'.
                            format(e.__class__, passed))
-            # time.sleep(SLEEP)  # time to maybe restore the connection
+            if r is not None:
+                r.close()
+            if partial and partial.bytes_done > bytes_before:
+                tried -= 1  # connection was lost in the middle, reconnect at once
+            else:
+                breaker.failure(url)
+                if tried < policy.attempts:
+                    delay = policy.delay(tried)  # time to maybe restore the connection
+                    _count_retry(metrics, delay)
             continue  # this is needed because timeout==False in case of exceptions
 
-        if tmp_path is None:
-            loaded = r.content
-            r.close()
+        if not timeout and partial.complete:
+            partial.finish()
+            loaded = LoadedFile(tmp_path, partial.bytes_done, partial.digests(), partial)
+            if metrics is not None:
+                seconds = time.time() - start_f
+                metrics.observe('download', seconds)
+                transferred = max(partial.bytes_done - bytes_first, 0)
+                metrics.observe('download_bytes_per_s', transferred / max(seconds, 1e-6))
+                metrics.observe('hash', partial.hash_seconds)
+                metrics.count('bytes', transferred)
             break
-        else:
-            if not timeout:
-                with open(tmp_path, 'rb') as tmp:
-                    loaded = tmp.read()
-                    break
+        if partial.bytes_done > bytes_before:
+            tried -= 1
 
     elapsed = round(time.time() - start_f, 2)
     logger.debug('Elapsed \t{}\t min\n'.format(elapsed * SEC_2_MIN))
-    return loaded, tried
\ No newline at end of file
+    return loaded, tried
+
+
+def _count_retry(metrics, delay):
+    if metrics is not None:
+        metrics.count('retries')
+        metrics.observe('backoff_wait', delay)
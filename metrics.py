@@ -0,0 +1,148 @@
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import logging
+logger = logging.getLogger()
+
+
+SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+RATE_BUCKETS = tuple(mb * 1e6 for mb in (0.1, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500))  # bytes/s
+RATE_SUFFIX = '_bytes_per_s'
+PROMETHEUS_PREFIX = 'loader'
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': round(self.sum, 4),
+                'mean': round(self.sum / self.count, 4) if self.count else None,
+                'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], self.counts))}
+
+
+class ProductMetrics:
+    """ RunMetrics of one product: everything is recorded in the run histograms and in the product record """
+    def __init__(self, run, uuid):
+        self.run = run
+        self.uuid = uuid
+
+    def observe(self, name, value):
+        self.run.observe(name, value, self.uuid)
+
+    def count(self, name, n=1):
+        self.run.count(name, n, self.uuid)
+
+    def timer(self, name):
+        return self.run.timer(name, self.uuid)
+
+
+class RunMetrics:
+    """
+    Per-stage timings of one run (search_page, ttfb, download, download_bytes_per_s, hash, checksum, extract,
+    backoff_wait, backpressure_wait) aggregated into histograms, counters (retries, bytes, store_hits) and
+    per-product records.
+    export() writes a json report, a Prometheus textfile and/or the `metrics` table of LoaderDB
+    """
+    def __init__(self, json_path=None, prometheus_path=None, loader_db=None, run_id=None):
+        self.json_path = json_path
+        self.prometheus_path = prometheus_path
+        self.db = loader_db
+        self.run_id = run_id or time.strftime('%Y%m%dT%H%M%S')
+        self.started = time.time()
+        self.histograms = {}
+        self.counters = {}
+        self.products = {}
+        self._lock = threading.Lock()
+
+    def product(self, uuid):
+        return ProductMetrics(self, uuid)
+
+    def observe(self, name, value, uuid=None):
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(RATE_BUCKETS if name.endswith(RATE_SUFFIX) else SECONDS_BUCKETS)
+            self.histograms[name].observe(value)
+            if uuid is not None:
+                record = self.products.setdefault(uuid, {})
+                record[name] = record.get(name, 0) + value
+
+    def count(self, name, n=1, uuid=None):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+            if uuid is not None:
+                record = self.products.setdefault(uuid, {})
+                record[name] = record.get(name, 0) + n
+
+    @contextmanager
+    def timer(self, name, uuid=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, uuid)
+
+    def report(self):
+        with self._lock:
+            return {'run_id': self.run_id,
+                    'started': self.started,
+                    'seconds': round(time.time() - self.started, 3),
+                    'histograms': {name: h.to_dict() for name, h in self.histograms.items()},
+                    'counters': dict(self.counters),
+                    'products': {uuid: dict(record) for uuid, record in self.products.items()}}
+
+    def prometheus(self):
+        lines = []
+        with self._lock:
+            for family, is_rate in (('stage_seconds', False), ('download_bytes_per_second', True)):
+                names = [name for name in self.histograms if name.endswith(RATE_SUFFIX) == is_rate]
+                if not names:
+                    continue
+                metric = '{}_{}'.format(PROMETHEUS_PREFIX, family)
+                lines.append('# TYPE {} histogram'.format(metric))
+                for name in names:
+                    h = self.histograms[name]
+                    stage = name[:-len(RATE_SUFFIX)] if is_rate else name
+                    cumulative = 0
+                    for le, n in zip([str(b) for b in h.buckets] + ['+Inf'], h.counts):
+                        cumulative += n
+                        lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(metric, stage, le, cumulative))
+                    lines.append('{}_sum{{stage="{}"}} {}'.format(metric, stage, h.sum))
+                    lines.append('{}_count{{stage="{}"}} {}'.format(metric, stage, h.count))
+            if self.counters:
+                metric = '{}_events_total'.format(PROMETHEUS_PREFIX)
+                lines.append('# TYPE {} counter'.format(metric))
+                for name, value in self.counters.items():
+                    lines.append('{}{{event="{}"}} {}'.format(metric, name, value))
+        return '\n'.join(lines) + '\n'
+
+    def export(self):
+        if self.json_path:
+            _write_atomic(self.json_path, json.dumps(self.report(), indent=2))
+        if self.prometheus_path:  # node_exporter must never read a half-written textfile
+            _write_atomic(self.prometheus_path, self.prometheus())
+        if self.db:
+            with self._lock:
+                rows = [(self.run_id, uuid, name, value)
+                        for uuid, record in self.products.items() for name, value in record.items()]
+            self.db.insert_metrics(rows, self.run_id)
+
+
+def _write_atomic(path, text):
+    with open(path + '.tmp', 'w') as f:
+        f.write(text)
+    os.replace(path + '.tmp', path)
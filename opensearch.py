@@ -0,0 +1,112 @@
+import io
+from datetime import datetime
+from xml.etree.ElementTree import iterparse
+
+import logging
+logger = logging.getLogger()
+
+
+DATE_FORMATS = ('%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+SIZE_UNITS = {'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3, 'TB': 1024 ** 4}
+
+
+class Product:
+    """
+    One <entry> of OpenSearch response, typed: dates are datetime (UTC), size is in bytes, clouds in %
+    """
+    __slots__ = ('uuid', 'name', 'date', 'ingestion_date', 'size', 'clouds', 'footprint')
+
+    def __init__(self, uuid, name, date=None, ingestion_date=None, size=None, clouds=None, footprint=None):
+        self.uuid = uuid
+        self.name = name
+        self.date = date
+        self.ingestion_date = ingestion_date
+        self.size = size
+        self.clouds = clouds
+        self.footprint = footprint
+
+    def __repr__(self):
+        return 'Product({}, {}, {}, {} B, clouds={})'.format(self.uuid, self.name, self.date, self.size, self.clouds)
+
+
+def parse_date(text):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format)
+        except ValueError:
+            continue
+    logger.warning('Unknown date format {}'.format(text))
+
+
+def format_date(date):
+    """ back to the format of the hub, f.e. 2018-04-01T10:23:45.123Z """
+    return date.isoformat(timespec='milliseconds') + 'Z'
+
+
+def parse_size(text):
+    """ '1.02 GB' -> bytes """
+    try:
+        value, unit = text.split()
+        return int(float(value) * SIZE_UNITS[unit.upper()])
+    except (ValueError, KeyError):
+        logger.warning('Unknown size format {}'.format(text))
+
+
+# <str/date/double name="..."> of an entry -> (Product attribute, parser)
+FIELDS = {
+    'uuid': ('uuid', str),
+    'identifier': ('name', str),
+    'beginposition': ('date', parse_date),
+    'ingestiondate': ('ingestion_date', parse_date),
+    'size': ('size', parse_size),
+    'cloudcoverpercentage': ('clouds', float),
+    'footprint': ('footprint', str),
+}
+
+
+def _local(tag):
+    return tag.rsplit('}', 1)[-1]  # without namespace
+
+
+def iter_page(source):
+    """
+    Incremental parser of one page of OpenSearch response (bytes or file-like).
+    Yields the number of total results (int) first if it is in the page, then Product per <entry>.
+    Every entry is dropped from the tree as soon as it is parsed, so memory doesn't grow with the page
+    """
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    fields = {}
+    root = None
+    for event, element in iterparse(source, events=('start', 'end')):
+        tag = _local(element.tag)
+        if event == 'start':
+            if root is None:
+                root = element
+            if tag == 'entry':
+                fields = {}
+            continue
+        if tag == 'totalResults':
+            yield int(element.text)
+        elif tag == 'entry':
+            if 'uuid' in fields and 'name' in fields:
+                yield Product(**fields)
+            else:
+                logger.warning('Entry without uuid or identifier is skipped: {}'.format(fields))
+            element.clear()
+            root.clear()  # parsed entries are not kept in <feed> either
+        elif element.get('name') in FIELDS and element.text is not None:
+            attribute, parser = FIELDS[element.get('name')]
+            fields[attribute] = parser(element.text.strip())
+
+
+def parse_page(source):
+    """ returns (total results, [Product]) """
+    total = 0
+    products = []
+    for item in iter_page(source):
+        if isinstance(item, Product):
+            products.append(item)
+        else:
+            total = item
+    return total, products
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import re
+import time
+
+import logging
+logger = logging.getLogger()
+
+
+SIDECAR_SUFFIX = '.json'
+SAVE_EVERY = 64 * 1024 * 1024  # bytes between sidecar updates
+RE_CONTENT_RANGE = r'bytes (\d+)-(\d+)/(\d+|\*)'
+
+
+class PartialDownload:
+    """
+    State of one download to `tmp_path`, kept next to it in a sidecar json (url, expected size, ETag, bytes done),
+    so the transfer can be resumed with a Range request after a timeout or in the next run.
+    hashlib objects can't be saved, so after a restart of the process the part on disk is hashed once again.
+    """
+    def __init__(self, tmp_path, url, hash_names):
+        self.tmp_path = tmp_path
+        self.sidecar_path = tmp_path + SIDECAR_SUFFIX
+        self.url = url
+        self.hash_names = tuple(hash_names)
+        self.size = None
+        self.etag = None
+        self.bytes_done = 0
+        self.hashes = [hashlib.new(name) for name in self.hash_names]
+        self._saved_at = 0
+        self.hash_seconds = 0
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.sidecar_path) or not os.path.exists(self.tmp_path):
+            return
+        try:
+            with open(self.sidecar_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning('Sidecar {} is broken ({}), download will restart'.format(self.sidecar_path, e))
+            return
+        if state.get('url') != self.url or tuple(state.get('hash_names', ())) != self.hash_names:
+            return
+        bytes_done = state.get('bytes_done', 0)
+        if os.path.getsize(self.tmp_path) < bytes_done:
+            return
+        with open(self.tmp_path, 'r+b') as tmp:
+            tmp.truncate(bytes_done)  # everything after the last save is not trusted
+            while True:
+                chunk = tmp.read(SAVE_EVERY // 16)
+                if not chunk:
+                    break
+                for h in self.hashes:
+                    h.update(chunk)
+        self.size = state.get('size')
+        self.etag = state.get('etag')
+        self.bytes_done = self._saved_at = bytes_done
+        logger.info('Resuming {} from {} of {} bytes'.format(self.tmp_path, bytes_done, self.size))
+
+    def range_headers(self):
+        if self.bytes_done == 0:
+            return {}
+        headers = {'Range': 'bytes={}-'.format(self.bytes_done)}
+        if self.etag and not self.etag.startswith('W/'):  # If-Range accepts only strong validators
+            headers['If-Range'] = self.etag
+        return headers
+
+    def accept(self, r):
+        """ checks the response to a (Range) request, returns the mode to open tmp file with """
+        etag = r.headers.get('ETag')
+        if r.status_code == 206:
+            match = re.match(RE_CONTENT_RANGE, r.headers.get('Content-Range', ''))
+            total = int(match.group(3)) if match and match.group(3) != '*' else self.size
+            if match and int(match.group(1)) == self.bytes_done and (self.size is None or total == self.size):
+                self.size = total
+                self.etag = etag or self.etag
+                return 'r+b'
+            logger.warning('Unexpected Content-Range {}, restarting {}'.format(r.headers.get('Content-Range'),
+                                                                              self.tmp_path))
+        elif self.bytes_done > 0:
+            logger.warning('Server did not honour Range for {}, restarting from zero'.format(self.tmp_path))
+        self.restart()
+        length = r.headers.get('Content-Length')
+        self.size = int(length) if length and length.isdigit() else None
+        self.etag = etag
+        return 'wb'
+
+    def restart(self):
+        self.bytes_done = self._saved_at = 0
+        self.size = self.etag = None
+        self.hashes = [hashlib.new(name) for name in self.hash_names]
+
+    def update(self, chunk, tmp):
+        start = time.perf_counter()
+        for h in self.hashes:
+            h.update(chunk)
+        self.hash_seconds += time.perf_counter() - start
+        self.bytes_done += len(chunk)
+        if self.bytes_done - self._saved_at >= SAVE_EVERY:
+            tmp.flush()  # sidecar must never claim more than is on disk
+            self.save()
+
+    def save(self):
+        if self.bytes_done == 0:
+            return
+        state = {'url': self.url, 'size': self.size, 'etag': self.etag,
+                 'bytes_done': self.bytes_done, 'hash_names': self.hash_names}
+        with open(self.sidecar_path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(self.sidecar_path + '.tmp', self.sidecar_path)
+        self._saved_at = self.bytes_done
+
+    @property
+    def complete(self):
+        return self.size is None or self.bytes_done == self.size
+
+    def digests(self):
+        return {name: h.hexdigest() for name, h in zip(self.hash_names, self.hashes)}
+
+    def finish(self):
+        if os.path.exists(self.sidecar_path):
+            os.remove(self.sidecar_path)
+
+    def discard(self):
+        """ removes the tmp file and the sidecar, f.e. if check sums were not equal """
+        self.finish()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
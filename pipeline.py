@@ -0,0 +1,121 @@
+import os
+import posixpath
+import shutil
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from fnmatch import fnmatch
+
+import logging
+logger = logging.getLogger()
+
+
+PART_SUFFIX = '.part'
+EXTRACT_BUFFER_SIZE = 1024 * 1024
+MAX_PENDING = 2  # downloaded products waiting for extraction, per extract worker
+
+
+def member_selected(filename, members):
+    """ `members` are glob patterns of the path in the zip or of the file name, None selects everything """
+    if members is None:
+        return True
+    return any(fnmatch(filename, pattern) or fnmatch(posixpath.basename(filename), pattern) for pattern in members)
+
+
+def extract_zip(path, unzip_path, members=None):
+    """
+    Members are streamed from the zip on disk (or any seekable file, see remote_zip.RangeFile), so memory use
+    doesn't depend on the product size. Only files matching `members` globs are extracted, folders always are.
+    Top level function: runs in the worker processes of the extract stage. Returns the name of the root folder
+    """
+    import zipfile
+    root = os.path.abspath(unzip_path)
+    with zipfile.ZipFile(path) as z:
+        name = z.namelist()[0].split('/')[0]  # name of the folder
+        folder = os.path.abspath(os.path.join(root, name))
+        if os.path.commonpath([root, folder]) == root:
+            os.makedirs(folder, exist_ok=True)  # the product is found on disk even if nothing matched
+        for member in z.infolist():
+            if not member.is_dir() and not member_selected(member.filename, members):
+                continue
+            target = os.path.abspath(os.path.join(root, member.filename))
+            if os.path.commonpath([root, target]) != root:
+                logger.error('Skipping {}: outside of {}'.format(member.filename, unzip_path))
+                continue
+            if member.is_dir():
+                os.makedirs(target, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            part = target + PART_SUFFIX
+            with z.open(member) as src, open(part, 'wb') as dst:
+                shutil.copyfileobj(src, dst, EXTRACT_BUFFER_SIZE)
+            os.replace(part, target)  # half-extracted files never appear under the real name
+    logger.info(f'SUCCESSFULLY UNZIPPED AND SAVED \n {name} in {unzip_path}')
+    return name
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    return func(*args), time.perf_counter() - start
+
+
+class BoundedStage:
+    """
+    One stage of the download -> extract pipeline: `workers` processes (or threads) behind a bounded queue.
+    submit() blocks while `max_pending` jobs are queued or running, so the stage before it (downloads) waits
+    instead of filling the disk faster than this stage drains it.
+    `then` callbacks run in threads of their own: the one which collects the results of the worker processes
+    isn't held by them
+    """
+    def __init__(self, workers=1, max_pending=None, processes=True):
+        self.workers = workers
+        self.max_pending = max_pending or workers * MAX_PENDING
+        self.processes = processes
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = None
+        self._finisher = None
+
+    def submit(self, func, *args, then=None, timer=None, waited=None):
+        """
+        Runs func(*args) in the stage and returns a Future of then(result) (`then` runs in a thread of this process).
+        `timer(seconds)` gets the run time of func, `waited(seconds)` the time submit() was blocked
+        """
+        start = time.perf_counter()
+        self._slots.acquire()
+        if waited is not None:
+            waited(time.perf_counter() - start)
+        future = Future()
+
+        def finish(job):
+            try:
+                value, seconds = job.result()
+                if timer is not None:
+                    timer(seconds)
+                future.set_result(then(value) if then is not None else value)
+            except BaseException as e:
+                future.set_exception(e)
+
+        def done(job):
+            self._slots.release()
+            self._finisher.submit(finish, job)
+
+        try:
+            self._executor.submit(_timed, func, *args).add_done_callback(done)
+        except BaseException:
+            self._slots.release()
+            raise
+        return future
+
+    def __enter__(self):
+        if self.processes:
+            from concurrent.futures import ProcessPoolExecutor as executor  # imports multiprocessing
+        else:
+            executor = ThreadPoolExecutor
+        self._executor = executor(max_workers=self.workers)
+        self._finisher = ThreadPoolExecutor(max_workers=self.workers)
+        return self
+
+    def __exit__(self, *exc):
+        self._executor.shutdown(wait=True)  # the last jobs hand their results to the finisher
+        self._finisher.shutdown(wait=True)
+        self._executor = self._finisher = None
@@ -0,0 +1,98 @@
+import os
+import threading
+import time
+from collections import Counter
+
+import logging
+logger = logging.getLogger()
+
+
+TYPICAL_CROPPED_LENGTH = 31
+SLSTR_PATTERN = '_SL_'
+RESTAT_INTERVAL = 10  # s between checks of the folder mtime
+
+
+class DirectoryIndex:
+    """
+    Names in one folder, listed once and listed again only if the mtime of the folder changed.
+    Lookups by the product name (entry without extension) and by the cropped prefix are O(1)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.names = Counter()
+        self.prefixes = Counter()
+        self._mtime = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        now = time.time()
+        if now - self._checked_at < RESTAT_INTERVAL:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        self.names.clear()
+        self.prefixes.clear()
+        if mtime is not None:
+            for entry in os.listdir(self.path):
+                self._add(entry)
+        logger.debug('Indexed {} entries in {}'.format(sum(self.names.values()), self.path))
+
+    def _add(self, entry):
+        self.names[entry.split('.', 1)[0]] += 1
+        self.prefixes[entry[:TYPICAL_CROPPED_LENGTH]] += 1
+
+    def add(self, entry):
+        with self._lock:
+            self._add(entry)
+
+    def count_name(self, name):
+        with self._lock:
+            self._refresh()
+            return self.names[name]
+
+    def count_prefix(self, prefix):
+        with self._lock:
+            self._refresh()
+            return self.prefixes[prefix]
+
+
+class PresenceIndex:
+    """
+    Answers if a product is already in `load_path` (exact name) or in `cropped_path`
+    (first TYPICAL_CROPPED_LENGTH symbols, SLSTR has 2 cropped files: SLSTR_1000, SLSTR_500)
+    """
+    def __init__(self, load_path, cropped_path):
+        self.loaded = DirectoryIndex(load_path)
+        self.cropped = DirectoryIndex(cropped_path)
+
+    def has_loaded(self, name):
+        """ is_loaded without logging """
+        return self.loaded.count_name(name) == 1
+
+    def is_loaded(self, name):
+        if self.has_loaded(name):
+            logger.critical('Product {} was already downloaded to {}'.format(name, self.loaded.path))
+            return True
+        return False
+
+    def has_cropped(self, name):
+        """ is_cropped without logging, f.e. for disk.DiskBudget looking for products to evict """
+        len_match = 2 if SLSTR_PATTERN in name else 1
+        return self.cropped.count_prefix(name[:TYPICAL_CROPPED_LENGTH]) == len_match
+
+    def is_cropped(self, name):
+        if self.has_cropped(name):
+            # making critical logs was not the best solution but now we can see in logs
+            logger.error('Cropped version of {} is already in {}'.format(name, self.cropped.path))
+            return True
+        return False
+
+    def add_loaded(self, entry):
+        self.loaded.add(entry)
@@ -0,0 +1,91 @@
+import io
+import re
+
+from get_request import get_request, REQUEST_TIMEOUT
+from retry import RequestError, UnauthorizedError
+
+import logging
+logger = logging.getLogger()
+
+
+BLOCK_SIZE = 64 * 1024  # read ahead for small reads (headers), large reads of members go as they are
+RE_CONTENT_RANGE = r'bytes \d+-\d+/(\d+)'
+
+
+class RangeNotSupportedError(RequestError):
+    pass
+
+
+def get_remote_size(url, auth, session=None):
+    """ size of the remote file from the Content-Range of a 1 byte request, the server has to answer 206 """
+    if session is None:
+        import requests as http
+    else:
+        http = session
+    r = http.get(url, auth=auth, stream=True, timeout=REQUEST_TIMEOUT, headers={'Range': 'bytes=0-0'})
+    if r.status_code == 206:
+        r.content  # the connection goes back to the pool only after the body is read
+    r.close()
+    if r.status_code == 401:
+        raise UnauthorizedError('401 UNAUTHORIZED for {}'.format(url))
+    match = re.match(RE_CONTENT_RANGE, r.headers.get('Content-Range', ''))
+    if r.status_code != 206 or match is None:
+        raise RangeNotSupportedError('Status code {} for a Range request to {}'.format(r.status_code, url))
+    return int(match.group(1))
+
+
+class RangeFile(io.RawIOBase):
+    """
+    Read-only seekable file over HTTP: every read is a Range request made by get_request (so with its retries,
+    `policy`, `breaker` and `slot`, passed in `kwargs`). zipfile.ZipFile reads the central directory and then
+    only the members which are opened, f.e. by pipeline.extract_zip with `members`.
+    Use open_remote() to get it buffered
+    """
+    def __init__(self, url, auth, session=None, size=None, **kwargs):
+        super().__init__()
+        self.url = url
+        self.auth = auth
+        self.session = session
+        self.kwargs = kwargs
+        self.size = get_remote_size(url, auth, session) if size is None else size
+        self.position = 0
+        self.bytes_fetched = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(offset, 0)
+        return self.position
+
+    def readinto(self, buffer):
+        end = min(self.position + len(buffer), self.size)
+        if end <= self.position:
+            return 0
+        content, tried = get_request(self.url, self.auth, session=self.session,
+                                     headers={'Range': 'bytes={}-{}'.format(self.position, end - 1)}, **self.kwargs)
+        if content is None:
+            raise RequestError('Range {}-{} of {} failed after {} attempts'.format(self.position, end, self.url, tried))
+        if len(content) != end - self.position:  # the whole file instead of the range
+            raise RangeNotSupportedError('Got {} bytes instead of {} from {}'
+                                         .format(len(content), end - self.position, self.url))
+        buffer[:len(content)] = content
+        self.position = end
+        self.bytes_fetched += len(content)
+        return len(content)
+
+
+def open_remote(url, auth, session=None, block_size=BLOCK_SIZE, **kwargs):
+    """ (buffered file for zipfile.ZipFile, RangeFile to see bytes_fetched) """
+    raw = RangeFile(url, auth, session, **kwargs)
+    return io.BufferedReader(raw, buffer_size=block_size), raw
@@ -0,0 +1,102 @@
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import logging
+logger = logging.getLogger()
+
+
+TRY_RECONNECT = 3
+BACKOFF_BASE = 2  # s
+BACKOFF_CAP = 600  # s
+RETRY_STATUSES = (408, 425, 429, 500, 502, 503, 504)
+BREAKER_THRESHOLD = 5  # failures in a row to open the circuit for a host
+BREAKER_COOLDOWN = 60  # s
+
+
+class RequestError(Exception):
+    pass
+
+
+class UnauthorizedError(RequestError):
+    pass
+
+
+def parse_retry_after(value):
+    """ Retry-After header (seconds or HTTP date) -> seconds, None if absent or broken """
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return int(value)
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter: attempt n waits random(0, min(cap, base * 2 ** n)),
+    Retry-After of the server wins if it is given
+    """
+    def __init__(self, attempts=TRY_RECONNECT, base=BACKOFF_BASE, cap=BACKOFF_CAP, retry_statuses=RETRY_STATUSES):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.retry_statuses = retry_statuses
+
+    def is_retryable(self, status_code):
+        return status_code in self.retry_statuses
+
+    def delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.cap)
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """
+    Per host, shared by all the workers: after `threshold` failures in a row (or Retry-After from the host)
+    the requests to that host wait until `cooldown` is over, requests to other hosts go on
+    """
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = {}
+        self._open_until = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url):
+        """ blocks while the circuit of the host is open, returns seconds waited """
+        host = urlparse(url).netloc
+        with self._lock:
+            wait = self._open_until.get(host, 0) - time.time()
+        if wait > 0:
+            logger.warning('Circuit for {} is open, waiting {:.0f}s'.format(host, wait))
+            time.sleep(wait)
+            return wait
+        return 0
+
+    def success(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            self._failures[host] = 0
+
+    def failure(self, url, retry_after=None):
+        host = urlparse(url).netloc
+        with self._lock:
+            self._failures[host] = self._failures.get(host, 0) + 1
+            open_for = retry_after
+            if open_for is None and self._failures[host] >= self.threshold:
+                open_for = self.cooldown
+            if open_for:
+                self._open_until[host] = max(self._open_until.get(host, 0), time.time() + open_for)
+                logger.warning('Circuit for {} is opened for {:.0f}s'.format(host, open_for))
+
+
+# shared by all get_request calls which don't bring their own
+DEFAULT_POLICY = RetryPolicy()
+DEFAULT_BREAKER = CircuitBreaker()
@@ -0,0 +1,129 @@
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import logging
+logger = logging.getLogger()
+
+
+B2MB = 1e-6
+
+# policy -> key to sort opensearch.Product (LoaderDB has the same policies in SQL)
+ORDERINGS = {
+    'queue': None,
+    'smallest': lambda p: (p.size is None, p.size or 0),
+    'newest': lambda p: (p.date is None, -p.date.timestamp() if p.date else 0),
+    'date': lambda p: (p.date is None, p.date or datetime.min),
+}
+
+
+class BandwidthLimiter:
+    """
+    Token bucket shared by all the download threads, `bytes_per_second` None means no limit
+    """
+    def __init__(self, bytes_per_second=None, burst_seconds=1):
+        self.rate = bytes_per_second
+        self.capacity = (bytes_per_second or 0) * burst_seconds
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, n_bytes):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate) - n_bytes
+            self._updated = now
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class ByteBudget:
+    """
+    Limits the sum of sizes of products loaded at the same time. One product bigger than the budget
+    is still loaded, but alone
+    """
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.in_use = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def hold(self, n_bytes):
+        n_bytes = n_bytes or 0
+        if not self.max_bytes:
+            yield
+            return
+        with self._condition:
+            self._condition.wait_for(lambda: self.in_use == 0 or self.in_use + n_bytes <= self.max_bytes)
+            self.in_use += n_bytes
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_use -= n_bytes
+                self._condition.notify_all()
+
+
+class Progress:
+    """ bytes loaded in this run and projected completion time """
+    def __init__(self):
+        self.total_bytes = 0
+        self.done_bytes = 0
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def expect(self, n_bytes):
+        with self._lock:
+            self.total_bytes += n_bytes or 0
+
+    def add(self, n_bytes):
+        with self._lock:
+            self.done_bytes += n_bytes
+
+    def rate(self):
+        """ bytes/s """
+        elapsed = time.time() - self.started
+        return self.done_bytes / elapsed if elapsed > 0 else 0
+
+    def eta(self):
+        """ datetime when everything expected will be loaded at the current rate, None if nothing was loaded yet """
+        rate = self.rate()
+        if not rate:
+            return None
+        return datetime.now() + timedelta(seconds=max(self.total_bytes - self.done_bytes, 0) / rate)
+
+    def report(self):
+        eta = self.eta()
+        return ('{:.1f} of {:.1f} MB, {:.2f} MB/s, projected completion {}'
+                .format(self.done_bytes * B2MB, self.total_bytes * B2MB, self.rate() * B2MB,
+                        eta.strftime('%Y-%m-%d %H:%M:%S') if eta else 'unknown'))
+
+
+class DownloadScheduler:
+    """
+    Order of products (`policy` from ORDERINGS), global bytes/s limit and budget of bytes loaded at the same time.
+    One scheduler can be shared by several Loaders
+    """
+    def __init__(self, policy='queue', bytes_per_second=None, max_concurrent_bytes=None):
+        if policy not in ORDERINGS:
+            raise Exception('Unknown order `{}`, expected one of {}'.format(policy, list(ORDERINGS)))
+        self.policy = policy
+        self.bandwidth = BandwidthLimiter(bytes_per_second)
+        self.budget = ByteBudget(max_concurrent_bytes)
+        self.progress = Progress()
+
+    def order(self, products):
+        key = ORDERINGS[self.policy]
+        return list(products) if key is None else sorted(products, key=key)
+
+    def slot(self, size):
+        return self.budget.hold(size)
+
+    def throttle(self, n_bytes):
+        """ called by get_request after every chunk """
+        self.progress.add(n_bytes)
+        self.bandwidth.consume(n_bytes)
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import shutil
+
+from pipeline import PART_SUFFIX
+
+import logging
+logger = logging.getLogger()
+
+
+LINK_MODES = ('hardlink', 'reflink', 'copy')
+FICLONE = 0x40049409  # ioctl of linux/fs.h, copy-on-write clone on btrfs, xfs, ...
+
+
+def members_key(members):
+    """ the same product extracted with other `members` globs is another entry of the store """
+    if members is None:
+        return 'all'
+    return hashlib.sha1(json.dumps(sorted(members)).encode()).hexdigest()[:12]
+
+
+def tree_stat(path):
+    """ (total size, the newest mtime_ns) of a file or of all the files in a folder, None if it doesn't exist """
+    if not os.path.exists(path):
+        return None
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+    size = 0
+    mtime_ns = os.stat(path).st_mtime_ns
+    for folder, _, files in os.walk(path):
+        for name in files:
+            stat = os.stat(os.path.join(folder, name))
+            size += stat.st_size
+            mtime_ns = max(mtime_ns, stat.st_mtime_ns)
+    return size, mtime_ns
+
+
+def _reflink(src, dst):
+    import fcntl  # not on Windows
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def link_file(src, dst, modes=LINK_MODES):
+    """ the first of `modes` which works on this file system, returns it """
+    for mode in modes:
+        try:
+            if mode == 'hardlink':
+                os.link(src, dst)
+            elif mode == 'reflink':
+                _reflink(src, dst)
+            else:
+                shutil.copy2(src, dst)
+            return mode
+        except (OSError, ImportError) as e:
+            if os.path.exists(dst):
+                os.remove(dst)
+            logger.debug('{} of {} failed: {}'.format(mode, src, e))
+    raise OSError('Could not link {} to {}'.format(src, dst))
+
+
+def materialize(src, dst, modes=LINK_MODES):
+    """ file or folder `src` appears as `dst` at once: the tree is linked under a .part name and renamed """
+    part = dst + PART_SUFFIX
+    if os.path.isdir(part):
+        shutil.rmtree(part)
+    if not os.path.isdir(src):
+        link_file(src, part, modes)
+    else:
+        for folder, _, files in os.walk(src):
+            target = os.path.join(part, os.path.relpath(folder, src))
+            os.makedirs(target, exist_ok=True)
+            for name in files:
+                link_file(os.path.join(folder, name), os.path.join(target, name), modes)
+    os.replace(part, dst)
+
+
+class ProductStore:
+    """
+    Products extracted once under `root`/uuid/md5 of the zip (`ranges` for members loaded with Range requests),
+    recorded in the `store` table of `loader_db` with the size and mtime of the tree, and linked into every
+    load_path which asks for them (`link` is the first of LINK_MODES to try).
+    A stored product is trusted while its size and mtime are the recorded ones: it isn't hashed again.
+    Hard links share the files with the load paths, so a product changed in a load path is loaded again
+    """
+    def __init__(self, root, loader_db, link='hardlink'):
+        self.root = root
+        self.db = loader_db
+        self.modes = LINK_MODES[LINK_MODES.index(link):]
+
+    def folder(self, uuid, checksum, members):
+        """ where a product is extracted to be stored """
+        name = checksum or 'ranges'
+        if members is not None:
+            name += '-' + members_key(members)
+        return os.path.join(self.root, uuid, name)
+
+    def get(self, uuid, members):
+        """ path of the stored product (folder or file) or None """
+        row = self.db.get_stored(uuid, members_key(members))
+        if row is None:
+            return None
+        path, checksum, size, mtime_ns = row
+        if tree_stat(path) != (size, mtime_ns):
+            logger.warning('{} was changed after it was stored, it will be loaded again'.format(path))
+            self.db.delete_stored(uuid, members_key(members))
+            return None
+        return path
+
+    def add(self, uuid, members, path, checksum=None):
+        """ `path` is the product extracted into folder(uuid, checksum, members) """
+        size, mtime_ns = tree_stat(path)
+        self.db.insert_stored(uuid, members_key(members), path, checksum, size, mtime_ns)
+        logger.info('{} is stored in {}'.format(uuid, path))
+
+    def materialize(self, uuid, members, load_path):
+        """ links the stored product into `load_path`, returns its entry name or None if it isn't stored """
+        path = self.get(uuid, members)
+        if path is None:
+            return None
+        entry = os.path.basename(path)
+        target = os.path.join(load_path, entry)
+        if not os.path.exists(target):
+            os.makedirs(load_path, exist_ok=True)
+            materialize(path, target, self.modes)
+            logger.info('{} is linked from the store to {}'.format(entry, load_path))
+        elif os.path.isdir(path):  # extracted before with other members: the missing files are added
+            for folder, _, files in os.walk(path):
+                target_folder = os.path.join(target, os.path.relpath(folder, path))
+                os.makedirs(target_folder, exist_ok=True)
+                for name in files:
+                    if not os.path.exists(os.path.join(target_folder, name)):
+                        link_file(os.path.join(folder, name), os.path.join(target_folder, name), self.modes)
+        return entry
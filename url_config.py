@@ -50,11 +50,21 @@ urls = {
         }
 }
 
+# glob patterns of zip members to extract per (platformname, producttype), everything if absent, f.e.
+# ('Sentinel-3', 'OL_1_EFR___'): ['xfdumanifest.xml', 'geo_coordinates.nc', 'Oa0[6-8]_radiance.nc']
+member_filters = {}
 
-def get_urls_and_query(platform_name):
-    url_dict = urls[platform_name]
+
+def get_urls_and_query(platform_name, filters=None):
+    """
+    `filters` (filters.FilterSpec) add what the hub can search for to the query.
+    url_dict is a copy: every Loader puts its own auth into it
+    """
+    url_dict = dict(urls[platform_name])
+    clause = filters.query_clause(url_dict['platformname']) if filters is not None else ''
     query_template = '(footprint:"Intersects({{polygon}})") AND ' \
                      '(beginPosition:[{{date_start}}T00:00:00.000Z TO {{date_end}}T23:59:59.999Z] AND ' \
                      'endPosition:[{{date_start}}T00:00:00.000Z TO {{date_end}}T23:59:59.999Z] ) AND ' \
-                     '(platformname:{platform_name} AND {{level_or_type}})&rows=100&start={{start}}'.format(platform_name=platform_name)
+                     '(platformname:{platform_name} AND {{level_or_type}}){filters}&rows=100&start={{start}}'.format(
+                         platform_name=platform_name, filters=' AND ({})'.format(clause) if clause else '')
     return url_dict, query_template